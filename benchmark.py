@@ -0,0 +1,576 @@
+"""
+Offline benchmarks for wikidata_films.py against a local stand-in for the Wikidata query service.
+
+The stand-in replays responses for QUERY 1-10 and the genre stats, either recorded from query.wikidata.org
+(see --record) or generated, at configurable sizes, latency and throttling. Results are appended to
+benchmark_history.jsonl so slower runs can be spotted with --check.
+
+    python benchmark.py                        # run all benchmarks
+    python benchmark.py --sizes 10000,200000   # QUERY 1 sizes for the parse benchmarks
+    python benchmark.py --latency 0.2 --throttle 0.1
+    python benchmark.py --record               # record real responses into benchmark_fixtures/
+    python benchmark.py --check                # exit with 1 if a benchmark got slower than its recent runs
+"""
+import argparse
+import builtins
+import contextlib
+import gzip
+import io
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import wikidata_films
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+fixture_dir = os.path.join(base_dir, 'benchmark_fixtures')
+history_path = os.path.join(base_dir, 'benchmark_history.jsonl')
+startup_budget = 0.1  # seconds from process start to the first prompt of the interactive menu
+# both ways of starting the menu are held to the budget
+startup_entries = ('python -m wikidata_films to first prompt', 'python films.py to first prompt')
+# modules that must not be imported by "import wikidata_films", they are loaded when a code path needs them
+deferred_modules = ('requests', 'urllib3', 'sqlite3', 'hashlib', 'webbrowser', 'argparse', 'email.utils',
+                    'concurrent.futures', 'html')
+regression_threshold = 1.25  # slower than 125% of the recent median counts as regression
+history_runs = 5
+
+title_words = ['the', 'last', 'night', 'city', 'love', 'war', 'dark', 'blue', 'river', 'king', 'story', 'dead',
+               'house', 'man', 'girl', 'road', 'secret', 'summer', 'star', 'ghost', 'lost', 'day', 'heart', 'fire']
+genders = ['male', 'female', 'non-binary', 'trans woman']
+
+# film used when recording the per-film queries (The Matrix, an action film)
+record_genre = 'Q188473'
+record_film = 'Q83495'
+
+
+def query_name(query: str) -> str:
+    """
+    Tells which of the tool's queries a request is from the parts of the query text that identify it.
+    """
+    if 'SELECT ?class' in query:
+        return 'FILM CLASSES'
+    if 'box_amount' in query:
+        return 'STATS amounts'
+    if 'dateModified' in query:
+        return 'STATS films' if 'P166' in query else 'STATS modified'
+    if 'VALUES ?film' in query and 'wdt:' not in query:
+        return 'STATS labels'
+    if 'P915' in query:
+        return 'QUERY 9'
+    if 'wd:Q39' in query:
+        return 'QUERY 10'
+    if 'sex_gender_list' in query:
+        return 'QUERY 5'
+    if 'AVG(' in query:
+        return 'QUERY 4'
+    if 'directorLabel' in query:
+        return 'QUERY 7'
+    if 'P2142' in query:
+        return 'QUERY 6'
+    if 'CONTAINS' in query:
+        return 'QUERY 3'
+    if 'VALUES ?film' in query:
+        return 'QUERY 2'
+    return 'QUERY 1'
+
+
+def fixture_path(name: str) -> str:
+    return os.path.join(fixture_dir, name.replace(' ', '_') + '.json.gz')
+
+
+def load_fixture(name: str):
+    path = fixture_path(name)
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rt', encoding='utf-8') as fixture:
+        return json.load(fixture)
+
+
+def uri(entity_id):
+    return {'type': 'uri', 'value': wikidata_films.entity_prefix + entity_id}
+
+
+def literal(value, lang=None):
+    term = {'type': 'literal', 'value': str(value)}
+    if lang:
+        term['xml:lang'] = lang
+    return term
+
+
+def results(bindings, variables=()):
+    return {'head': {'vars': list(variables)}, 'results': {'bindings': bindings}}
+
+
+class Fixtures:
+    """
+    Responses for every query, recorded ones where available and generated ones otherwise.
+    Film listings of any size are built by cycling through the recorded (or generated) QUERY 1 films.
+    """
+    def __init__(self):
+        recorded = load_fixture('QUERY 1')
+        self.base_films = recorded['results']['bindings'] if recorded else None
+        self.films_cache = {}
+
+    def title(self, rng):
+        return ' '.join(rng.choice(title_words) for _ in range(rng.randint(1, 4))).title()
+
+    def films(self, count: int) -> list:
+        if count not in self.films_cache:
+            rng = random.Random(count)
+            bindings = []
+            for index in range(count):
+                if self.base_films:
+                    base = self.base_films[index % len(self.base_films)]
+                    label = base.get('filmLabel', {}).get('value', '')
+                else:
+                    label = self.title(rng)
+                bindings.append({'film': uri(f'Q{1000000 + index}'), 'filmLabel': literal(label, 'en')})
+            self.films_cache = {count: bindings}  # keep only one size, the large ones are big
+        return self.films_cache[count]
+
+    def response(self, name: str, query: str, film_count: int) -> dict:
+        # listings are scaled and per-film results follow the films asked for, the rest is replayed as recorded
+        if name not in ('QUERY 1', 'QUERY 4', 'QUERY 5', 'QUERY 6', 'QUERY 7') and 'VALUES' not in query:
+            recorded = load_fixture(name)
+            if recorded is not None:
+                return recorded
+        rng = random.Random(query)
+        values = re.search(r'VALUES \?film\s*\{([^}]*)\}', query)
+        films = re.findall(r'wd:(Q\d+)', values.group(1)) if values else []
+        if name == 'QUERY 1':
+            bindings = self.films(film_count)
+            after = re.search(r'STR\(\?film\) > "([^"]*)"', query)
+            limit = re.search(r'LIMIT (\d+)', query)
+            if after:  # keyset page of the listing
+                bindings = sorted(bindings, key=lambda binding: binding['film']['value'])
+                bindings = [binding for binding in bindings if binding['film']['value'] > after.group(1)]
+            if limit:
+                bindings = bindings[:int(limit.group(1))]
+            return results(bindings, ('film', 'filmLabel'))
+        if name == 'FILM CLASSES':
+            return results([{'class': uri(f'Q{11424 + index}')} for index in range(800)], ('class',))
+        if name == 'QUERY 9':
+            return results([{'film': binding['film'], 'filmLabel': binding['filmLabel'],
+                             'coords': literal(f'Point({rng.uniform(-180, 180):.4f} {rng.uniform(-60, 70):.4f})')}
+                            for binding in self.films(film_count)])
+        if name == 'QUERY 10':
+            return results([{'cast_member': uri(f'Q{2000000 + index}'), 'cast_memberLabel': literal(self.title(rng)),
+                             'coordinates': literal(f'Point({rng.uniform(6, 10.5):.4f} {rng.uniform(45.8, 47.8):.4f})'),
+                             'film_list': literal(', '.join(self.title(rng) for _ in range(rng.randint(1, 5))))}
+                            for index in range(200)])
+        if name in ('QUERY 2', 'QUERY 3'):
+            return results(self.films(film_count)[:1], ('film', 'filmLabel'))
+        if name == 'QUERY 4':
+            return results([{'film': uri(film), 'avg': literal(round(rng.uniform(20, 60), 3))} for film in films])
+        if name == 'QUERY 5':
+            return results([{'film': uri(film), 'sex_gender_list': literal(gender),
+                             'count': literal(rng.randint(1, 40))}
+                            for film in films for gender in genders[:rng.randint(1, len(genders))]])
+        if name == 'QUERY 6':
+            bindings = []
+            for film in films:
+                cost = rng.randint(10 ** 5, 10 ** 8)
+                box = rng.randint(10 ** 5, 10 ** 9)
+                bindings.append({'film': uri(film), 'box': literal(box), 'cost': literal(cost),
+                                 'difference': literal(box - cost),
+                                 'cost_unitLabel': literal('United States dollar')})
+            return results(bindings)
+        if name == 'QUERY 7':
+            bindings = []
+            for film in films:
+                for director in range(rng.randint(1, 3)):
+                    other_films = [self.title(rng) for _ in range(rng.randint(5, 60))]
+                    bindings.append({'film': uri(film), 'directorLabel': literal(f'Director {director}'),
+                                     'film_list': literal(' ~ '.join(other_films)),
+                                     'count': literal(len(other_films))})
+            return results(bindings)
+        # genre stats, every film of the listing or the ones asked for
+        films = films or [binding['film']['value'][len(wikidata_films.entity_prefix):]
+                          for binding in self.films(film_count)]
+        if name == 'STATS films':
+            return results([{'film': uri(film), 'modified': literal('2024-01-01T00:00:00Z'),
+                             'awards': literal(rng.choice((0, 0, 0, 1, 2, 5, 20))),
+                             'year': literal(rng.randint(1920, 2024))} for film in films])
+        if name == 'STATS labels':
+            return results([{'film': uri(film), 'filmLabel': literal(self.title(rng), 'en')} for film in films])
+        if name == 'STATS modified':
+            return results([{'film': uri(film), 'modified': literal('2024-01-01T00:00:00Z')} for film in films])
+        bindings = []
+        for film in films:
+            if rng.random() < 0.3:
+                unit = uri(rng.choice(('Q4917', 'Q4917', 'Q4916', 'Q25224')))
+                bindings.append({'film': uri(film), 'unit': unit, 'box': literal(rng.randint(10 ** 5, 10 ** 9)),
+                                 'cost': literal(rng.randint(10 ** 5, 10 ** 8))})
+        return results(bindings)
+
+
+class MockEndpoint:
+    """
+    Local HTTP server answering SPARQL requests like the query service, with added latency and a share of
+    requests throttled with 429 and Retry-After.
+    """
+    def __init__(self, fixtures: Fixtures, latency=0.0, throttle=0.0, film_count=10000):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.throttle = throttle
+        self.film_count = film_count
+        self.requests = 0
+        self.throttled = 0
+        self.bodies = {}  # (query, film count) -> (json bytes, gzip bytes), serialising is not what we measure
+        self.rng = random.Random(1)
+        self.lock = threading.Lock()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                endpoint.handle(self, parse_qs(urlparse(self.path).query).get('query', [''])[0])
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                endpoint.handle(self, parse_qs(body).get('query', [''])[0])
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/sparql'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def body(self, query):
+        key = (query, self.film_count)
+        with self.lock:
+            if key not in self.bodies:
+                if len(self.bodies) > 16:
+                    self.bodies.clear()
+                text = json.dumps(self.fixtures.response(query_name(query), query, self.film_count)).encode()
+                self.bodies[key] = (text, gzip.compress(text, 1))
+            return self.bodies[key]
+
+    def handle(self, request, query):
+        with self.lock:
+            self.requests += 1
+            throttled = self.rng.random() < self.throttle
+            self.throttled += throttled
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            request.send_response(429)
+            request.send_header('Retry-After', '0')
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+        plain, compressed = self.body(query)
+        use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/sparql-results+json')
+        if use_gzip:
+            request.send_header('Content-Encoding', 'gzip')
+        request.send_header('Content-Length', str(len(compressed if use_gzip else plain)))
+        request.end_headers()
+        request.wfile.write(compressed if use_gzip else plain)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def use_endpoint(url):
+    """
+    Points wikidata_films at the mock endpoint, without result cache and client-side rate limit.
+    """
+    wikidata_films.endpoint_url = url
+    wikidata_films.cache_dir = None
+    wikidata_films._cache = None
+    wikidata_films._stats = None
+    wikidata_films._film_classes = None
+    wikidata_films.rate_limiter = wikidata_films.RateLimiter(0)
+    wikidata_films.backoff_factor = 0.01
+
+
+def cold():
+    """
+    Drops all cached results and genre stats so the next run has to ask the endpoint again.
+    """
+    wikidata_films._cache = None
+    wikidata_films._stats = None
+
+
+def measure(function, repeat, setup=cold):
+    """
+    Runs function repeat times, each after setup, and returns the wall times in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        setup()
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def bench_parse(endpoint, sizes, repeat):
+    results_ = {}
+    phases = {}
+    hook = wikidata_films.add_query_hook(lambda record: phases.setdefault(record['name'], []).append(record))
+    try:
+        for size in sizes:
+            endpoint.film_count = size
+            query = wikidata_films.genre_films_query('Q188473')
+            wikidata_films.get_results_request(query, use_cache=False)  # warm up the mock's body cache
+            phases.clear()
+            totals = measure(lambda: wikidata_films.get_results_request(query, use_cache=False, name='parse'),
+                             repeat)
+            results_[f'get_results_request QUERY 1 n={size}'] = totals
+            results_[f'get_results_request QUERY 1 n={size} parse only'] = [record['parse']
+                                                                             for record in phases['parse']]
+            results_[f'iter_results_request QUERY 1 n={size}'] = measure(
+                lambda: sum(1 for _ in wikidata_films.iter_results_request(query, use_cache=False)), repeat)
+    finally:
+        wikidata_films.query_hooks.remove(hook)
+    return results_
+
+
+def bench_paging(endpoint, sizes, repeat):
+    results_ = {}
+    endpoint.film_count = max(sizes)
+    bindings = endpoint.fixtures.films(endpoint.film_count)
+    table = wikidata_films.FilmTable.from_bindings(bindings)
+    response = results(bindings)
+
+    def page_through(source, rows=1000):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for offset in range(0, rows, 10):
+                wikidata_films.print_request(source, offset, offset + 10)
+
+    results_[f'print_request parsed response n={len(bindings)}'] = measure(lambda: page_through(response), repeat)
+    results_[f'print_request FilmTable n={len(bindings)}'] = measure(lambda: page_through(table), repeat)
+    results_['print_request GenrePages 1000 rows'] = measure(
+        lambda: page_through(wikidata_films.GenrePages('Q188473')), repeat)
+    return results_
+
+
+def bench_directors(endpoint, repeat):
+    entity_ids = [f'Q{1000000 + index}' for index in range(200)]
+    query = wikidata_films.film_analytics_queries(*entity_ids)[4]
+    bindings = endpoint.fixtures.response('QUERY 7', query, endpoint.film_count)['results']['bindings']
+
+    def format_directors():
+        with contextlib.redirect_stdout(io.StringIO()):
+            wikidata_films.print_directors(bindings)
+
+    return {f'print_directors {len(bindings)} directors': measure(format_directors, repeat)}
+
+
+def bench_map(endpoint, sizes, repeat):
+    endpoint.film_count = max(sizes)
+    query = wikidata_films.filming_locations_query('Q188473')
+    bindings = endpoint.fixtures.response('QUERY 9', query, endpoint.film_count)['results']['bindings']
+
+    def render():
+        features = wikidata_films.map_features(bindings, 'coords', 'filmLabel', 'film')
+        wikidata_films.write_map(features, 'benchmark', 'benchmark')
+
+    return {f'map_features and write_map QUERY 9 n={len(bindings)}': measure(render, repeat)}
+
+
+# answers for one session through main(): a film via label search with all four options, then the
+# awards top 10 and the USD box office top 10 of a genre from the genre stats
+session_inputs = ['1', '1', '3', '3', '2', 'the', '1', '1', '1', '2', '1', '3', '1', '4', '2',
+                  '1', '2', '2', '1', '10', '199O', '', '1', '1', '4', '10', '', '4', '2', '1', '2', '2']
+
+
+def run_session(inputs=session_inputs):
+    answers = iter(inputs)
+
+    def scripted_input(prompt=''):
+        try:
+            return next(answers)
+        except StopIteration:
+            raise RuntimeError(f'scripted session ran out of answers at prompt {prompt!r}') from None
+
+    original_input = builtins.input
+    builtins.input = scripted_input
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            wikidata_films.main()
+    finally:
+        builtins.input = original_input
+
+
+def bench_session(endpoint, repeat):
+    endpoint.film_count = 10000
+    return {f'main() scripted session latency={endpoint.latency}s': measure(run_session, repeat)}
+
+
+def time_to_prompt(args, env) -> float:
+    """
+    Starts python with args and returns the seconds until it prints its first ">>" prompt.
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, *args], cwd=base_dir, env=env, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = b''
+    try:
+        while b'>>' not in output:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                raise RuntimeError(f'{" ".join(args)} exited before its first prompt')
+            output += chunk
+        return time.perf_counter() - started
+    finally:
+        process.kill()
+        process.wait()
+
+
+def time_process(args, env) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=base_dir, env=env, check=True)
+    return time.perf_counter() - started
+
+
+def bench_startup(repeat):
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(base_dir, 'wikidata_films.py')],
+                   check=True)
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, wikidata_films; print(" ".join(sys.modules))'],
+                            cwd=base_dir, env=env, capture_output=True, text=True, check=True).stdout.split()
+    eager = [name for name in deferred_modules if name in loaded]
+    if eager:
+        print(f'imported at start up although deferred: {", ".join(eager)}', file=sys.stderr)
+    return {'python -c pass': [time_process(['-c', 'pass'], env) for _ in range(repeat)],
+            'python -c "import wikidata_films"': [time_process(['-c', 'import wikidata_films'], env)
+                                                  for _ in range(repeat)],
+            'python -m wikidata_films to first prompt': [time_to_prompt(['-m', 'wikidata_films'], env)
+                                                         for _ in range(repeat)],
+            'python films.py to first prompt': [time_to_prompt(['films.py'], env) for _ in range(repeat)]}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=base_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path=history_path) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as history:
+        return [json.loads(line) for line in history if line.strip()]
+
+
+def compare(summary: dict, history: list) -> list:
+    """
+    Returns (name, median, baseline) for every benchmark slower than regression_threshold times the median of
+    its last history_runs recorded medians.
+    """
+    regressions = []
+    for name, stats in summary.items():
+        previous = [run['results'][name]['median'] for run in history if name in run['results']][-history_runs:]
+        if previous:
+            baseline = statistics.median(previous)
+            if stats['median'] > baseline * regression_threshold:
+                regressions.append((name, stats['median'], baseline))
+    return regressions
+
+
+def record(genre_id=record_genre, film_id=record_film):
+    """
+    Saves real responses of the live endpoint for every query as fixtures.
+    """
+    os.makedirs(fixture_dir, exist_ok=True)
+    selector = wikidata_films.films_selector([film_id])
+    queries = {'FILM CLASSES': wikidata_films.film_classes_query(),
+               'QUERY 1': wikidata_films.genre_films_query(genre_id),
+               'QUERY 9': wikidata_films.filming_locations_query(genre_id),
+               'QUERY 10': wikidata_films.swiss_cast_query(genre_id),
+               'STATS films': wikidata_films.stats_films_query(selector),
+               'STATS amounts': wikidata_films.stats_amounts_query(selector),
+               'STATS modified': wikidata_films.stats_modified_query(genre_id),
+               'STATS labels': wikidata_films.stats_labels_query([film_id])}
+    queries.update({wikidata_films.film_analytics_names[option]: query
+                    for option, query in wikidata_films.film_analytics_queries(film_id).items()})
+    for name, query in queries.items():
+        started = time.perf_counter()
+        text = wikidata_films.send_query(query).text
+        with gzip.open(fixture_path(name), 'wt', encoding='utf-8') as fixture:
+            fixture.write(text)
+        print(f'{name:<12s} {len(text):>12,d} bytes {time.perf_counter() - started:8.2f} s')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks for wikidata_films.py.')
+    parser.add_argument('--sizes', default='10000,50000,200000', help='QUERY 1 sizes for the parse benchmarks')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the mock endpoint waits per request')
+    parser.add_argument('--throttle', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--only', help='run only benchmarks whose group matches: parse, paging, directors, map, '
+                                       'session, startup')
+    parser.add_argument('--record', action='store_true', help='record fixtures from the live endpoint and exit')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with 1 on regressions against history or a start up over budget')
+    parser.add_argument('--no-save', action='store_true', help='do not append this run to the history')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record()
+        return 0
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    timings = {}
+    with MockEndpoint(Fixtures(), args.latency, args.throttle) as endpoint:
+        use_endpoint(endpoint.url)
+        groups = {'parse': lambda: bench_parse(endpoint, sizes, args.repeat),
+                  'paging': lambda: bench_paging(endpoint, sizes, args.repeat),
+                  'directors': lambda: bench_directors(endpoint, args.repeat),
+                  'map': lambda: bench_map(endpoint, sizes, args.repeat),
+                  'session': lambda: bench_session(endpoint, args.repeat),
+                  'startup': lambda: bench_startup(args.repeat)}
+        for group, run in groups.items():
+            if args.only is None or args.only == group:
+                timings.update(run())
+        throttled = endpoint.throttled
+
+    summary = {name: {'median': statistics.median(times), 'min': min(times), 'runs': len(times)}
+               for name, times in timings.items()}
+    history = load_history()
+    regressions = compare(summary, history)
+
+    print(f'\n{"Benchmark":<60s} {"Median":>10s} {"Min":>10s}')
+    for name, stats in summary.items():
+        print(f'{name:<60s} {stats["median"] * 1000:>8.1f}ms {stats["min"] * 1000:>8.1f}ms')
+    if throttled:
+        print(f'\n{throttled} requests were throttled by the mock endpoint')
+    for name, median, baseline in regressions:
+        print(f'REGRESSION {name}: {median * 1000:.1f}ms, recent median {baseline * 1000:.1f}ms', file=sys.stderr)
+    over_budget = [(name, stats['median']) for name, stats in summary.items()
+                   if name in startup_entries and stats['median'] > startup_budget]
+    for name, median in over_budget:
+        print(f'OVER BUDGET {name}: {median * 1000:.1f}ms, budget {startup_budget * 1000:.0f}ms', file=sys.stderr)
+
+    if not args.no_save:
+        with open(history_path, 'a', encoding='utf-8') as history_file:
+            history_file.write(json.dumps({'time': time.time(), 'revision': git_revision(),
+                                           'python': sys.version.split()[0], 'latency': args.latency,
+                                           'throttle': args.throttle, 'results': summary}) + '\n')
+    return 1 if args.check and (regressions or over_budget) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
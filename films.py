@@ -0,0 +1,9 @@
+"""
+Entry script for wikidata_films: "python films.py" opens the interactive menu, "python films.py GENRE ..."
+runs a report (see python films.py --help). It is kept small so only this file is compiled on start, the
+module itself is loaded from its cached bytecode.
+"""
+import wikidata_films
+
+if __name__ == '__main__':
+    wikidata_films.start()
@@ -0,0 +1,386 @@
+"""
+Tests for the query building and result parsing helpers of wikidata_films, run with python -m pytest.
+"""
+import datetime
+import io
+import json
+import queue
+import re
+import threading
+
+import pytest
+
+import wikidata_films as w
+
+
+@pytest.mark.parametrize('value, literal', [
+    ('star wars', '"star wars"'),
+    ('say "hi"', r'"say \"hi\""'),
+    ('back\\slash', r'"back\\slash"'),
+    ('two\nlines\r\tend', r'"two\nlines\r\tend"'),
+    ('bell\x07', '"bell"'),
+    ('" } ; DROP ALL #', r'"\" } ; DROP ALL #"'),
+    (42, '"42"'),
+])
+def test_sparql_string(value, literal):
+    assert w.sparql_string(value) == literal
+
+
+def test_sparql_string_stays_one_literal():
+    # whatever the input, normalising the query must not touch the inside of the literal
+    literal = w.sparql_string('a "b" # c\n d')
+    assert w.normalize_query(f'FILTER(CONTAINS(?x, {literal}))') == f'FILTER(CONTAINS(?x, {literal}))'
+
+
+@pytest.mark.parametrize('value, entity', [
+    ('Q42', 'wd:Q42'),
+    ('q42', 'wd:Q42'),
+    (' Q11424 ', 'wd:Q11424'),
+])
+def test_sparql_entity(value, entity):
+    assert w.sparql_entity(value) == entity
+
+
+@pytest.mark.parametrize('value', ['', 'Q', 'Q0', 'Q012', 'P31', '42', 'Q42}', 'Q1 wd:Q2', 'wd:Q42', '199O'])
+def test_sparql_entity_rejects(value):
+    with pytest.raises(ValueError):
+        w.sparql_entity(value)
+
+
+def test_sparql_entities():
+    assert w.sparql_entities(['Q1', 'q2']) == 'wd:Q1 wd:Q2'
+    with pytest.raises(ValueError):
+        w.sparql_entities([])
+    with pytest.raises(ValueError):
+        w.sparql_entities(['Q1', 'Q2}'])
+
+
+@pytest.mark.parametrize('query, normalized', [
+    ('SELECT ?a\n  WHERE {  ?a ?b ?c. }', 'SELECT ?a WHERE { ?a ?b ?c. }'),
+    ('SELECT ?a # the film\nWHERE {}', 'SELECT ?a WHERE {}'),
+    ('# only a comment\nSELECT ?a', 'SELECT ?a'),
+    ('?a <http://example.org/x#y> ?b # comment', '?a <http://example.org/x#y> ?b'),
+    ('FILTER(?a < 3 && ?b > 1) # c', 'FILTER(?a < 3 && ?b > 1)'),
+    ('FILTER(?a = "x # y")  # c', 'FILTER(?a = "x # y")'),
+    ("FILTER(?a = 'it''s  #')", "FILTER(?a = 'it''s  #')"),
+    (r'FILTER(?a = "say \"#\"  ") # c', r'FILTER(?a = "say \"#\"  ")'),
+])
+def test_normalize_query(query, normalized):
+    assert w.normalize_query(query) == normalized
+
+
+def test_normalize_query_is_idempotent_for_prepared_queries():
+    for query in w.prepared_queries.values():
+        assert w.normalize_query(query.text) == query.text, query.name
+
+
+def test_prepared_query_validates_parameters():
+    bound = w.query_3.bind(genre='Q130232', text='he said "#"')
+    assert isinstance(bound, w.BoundQuery)
+    assert 'wd:Q130232' in bound and r'"he said \"#\""' in bound
+    assert w.cache_key(bound) == w.cache_key(str(bound))
+    with pytest.raises(ValueError):
+        w.query_3.bind(genre='Q1} ?x ?y {', text='')
+    with pytest.raises(TypeError):
+        w.query_3.bind(genre='Q1')
+    with pytest.raises(ValueError):
+        w.PreparedQuery('QUERY 3', 'SELECT ?a')
+
+
+def bindings_response(bindings):
+    return json.dumps({'head': {'vars': ['film', 'filmLabel']}, 'results': {'bindings': bindings}},
+                      ensure_ascii=False).encode()
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+bindings = [
+    {'film': {'type': 'uri', 'value': f'http://www.wikidata.org/entity/Q{n}'},
+     'filmLabel': {'type': 'literal', 'xml:lang': 'en', 'value': label}}
+    for n, label in [(1, 'Plain'), (2, 'Brackets ] and { braces }'), (3, 'Quote " and , comma'),
+                     (4, 'Ünïcödé – 映画'), (5, 'Back\\slash')]
+]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 10_000])
+def test_iter_json_bindings_split_chunks(size):
+    assert list(w.iter_json_bindings(split(bindings_response(bindings), size))) == bindings
+
+
+def test_iter_json_bindings_yields_before_the_end():
+    data = bindings_response(bindings)
+    cut = data.index(b'Q3')  # inside the third binding
+    parsed = w.iter_json_bindings(iter([data[:cut], data[cut:]]))
+    assert next(parsed) == bindings[0]
+    assert next(parsed) == bindings[1]
+    assert list(parsed) == bindings[2:]
+
+
+def test_iter_json_bindings_empty():
+    assert list(w.iter_json_bindings(split(bindings_response([]), 5))) == []
+
+
+def test_iter_json_bindings_truncated():
+    data = bindings_response(bindings)
+    with pytest.raises(ValueError):
+        list(w.iter_json_bindings(split(data[:data.index(b'Q4')], 3)))
+
+
+class StreamedResponse:
+    """
+    Stands in for a streamed requests response that delivers its body in the given chunks.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size=None):
+        return iter(self.chunks)
+
+
+csv_response = ('film,filmLabel\r\n'
+                'http://www.wikidata.org/entity/Q1,A\r\n'
+                'http://www.wikidata.org/entity/Q2,"Two\r\nlines, ""quoted"""\r\n'
+                'http://www.wikidata.org/entity/Q3,Ünïcödé\r\n').encode()
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 17, 10_000])
+def test_iter_response_bindings_csv_split_chunks(size):
+    rows = list(w.iter_response_bindings(StreamedResponse(split(csv_response, size)), 'csv'))
+    assert rows == [{'film': {'value': 'http://www.wikidata.org/entity/Q1'}, 'filmLabel': {'value': 'A'}},
+                    {'film': {'value': 'http://www.wikidata.org/entity/Q2'},
+                     'filmLabel': {'value': 'Two\r\nlines, "quoted"'}},
+                    {'film': {'value': 'http://www.wikidata.org/entity/Q3'}, 'filmLabel': {'value': 'Ünïcödé'}}]
+
+
+def test_iter_response_bindings_crlf_across_chunks():
+    first_line_end = csv_response.index(b'\r\n', csv_response.index(b'Q1'))
+    chunks = [csv_response[:first_line_end + 1], csv_response[first_line_end + 1:]]  # split between \r and \n
+    assert chunks[0].endswith(b'\r') and chunks[1].startswith(b'\n')
+    rows = list(w.iter_response_bindings(StreamedResponse(chunks), 'csv'))
+    assert [row['film']['value'][-2:] for row in rows] == ['Q1', 'Q2', 'Q3']
+
+
+def test_iter_response_bindings_tsv():
+    tsv = ('?film\t?filmLabel\t?count\r\n'
+           '<http://www.wikidata.org/entity/Q1>\t"Say \\"hi\\""@en\t3\r\n'
+           '<http://www.wikidata.org/entity/Q2>\t\t\r\n').encode()
+    rows = list(w.iter_response_bindings(StreamedResponse(split(tsv, 5)), 'tsv'))
+    assert rows == [{'film': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q1'},
+                     'filmLabel': {'type': 'literal', 'value': 'Say "hi"', 'xml:lang': 'en'},
+                     'count': {'type': 'literal', 'value': '3'}},
+                    {'film': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q2'}}]
+
+
+class StubResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.reason = 'Too Many Requests' if status_code == 429 else 'OK'
+        self.headers = headers or {}
+        self.ok = status_code < 400
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise w.requests.HTTPError(f'{self.status_code} {self.reason}', response=self)
+
+
+class StubSession:
+    """
+    Answers every request with the next of the given responses.
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def get(self, url, **kwargs):
+        return self.responses.pop(0)
+
+    post = get
+
+
+@pytest.fixture
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(w, 'rate_limiter', w.RateLimiter(0))
+    monkeypatch.setattr(w.time, 'sleep', lambda seconds: None)
+
+
+def test_retry_delay_keeps_long_retry_after():
+    assert w.retry_delay(StubResponse(429, {'Retry-After': '120'}), 0) == 120
+    assert 0 < w.retry_delay(StubResponse(503), 10) <= w.max_backoff
+
+
+def test_send_query_gives_up_on_long_retry_after(monkeypatch, no_waiting):
+    throttled = StubResponse(429, {'Retry-After': str(w.max_backoff + 1)})
+    monkeypatch.setattr(w, 'get_session', lambda: StubSession(throttled, StubResponse(200)))
+    with pytest.raises(w.requests.HTTPError, match='asked to wait'):
+        w.send_query('SELECT ?a')
+    assert throttled.closed
+
+
+def test_send_query_closes_last_failed_response(monkeypatch, no_waiting):
+    responses = [StubResponse(503) for _ in range(w.max_retries + 1)]
+    monkeypatch.setattr(w, 'get_session', lambda: StubSession(*responses))
+    with pytest.raises(w.requests.HTTPError):
+        w.send_query('SELECT ?a')
+    assert all(response.closed for response in responses)
+
+
+def test_send_query_retries_after_short_retry_after(monkeypatch, no_waiting):
+    answer = StubResponse(200)
+    monkeypatch.setattr(w, 'get_session', lambda: StubSession(StubResponse(429, {'Retry-After': '1'}), answer))
+    assert w.send_query('SELECT ?a') is answer and answer.retries == 1
+
+
+class StubExecutor:
+    """
+    Answers per-film queries at once with one binding per film of the query and counts the queries submitted.
+    """
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, query, kind='default', timeout=None, name='query'):
+        self.submitted += 1
+        films = re.findall(r'wd:(Q\d+)', query.split('}')[0])  # the VALUES block comes first
+        future = w.futures.Future()
+        future.set_result({'results': {'bindings': [{'film': {'value': w.entity_prefix + film}} for film in films]}})
+        return future
+
+
+def test_iter_film_analytics_streams_chunks(monkeypatch):
+    monkeypatch.setattr(w, 'film_class_values', lambda: '?class wdt:P279* wd:Q11424.')
+    executor = StubExecutor()
+    films = [f'Q{n}' for n in range(1, 101)]
+    analytics = w.iter_film_analytics(films + films[:5], executor=executor, size=10, window=2)
+    entity_id, options = next(analytics)
+    assert entity_id == 'Q1' and all(len(options[option]) == 1 for option in (1, 2, 3, 4))
+    assert executor.submitted == 3 * 4  # the chunk yielded and the two ahead of it, four queries each
+    assert [entity_id for entity_id, _ in analytics] == films[1:]
+    assert executor.submitted == 10 * 4
+
+
+def test_result_cache_memory_tier_is_limited_by_bytes():
+    cache = w.ResultCache(None, memory_size=10, memory_max_bytes=100, memory_max_entry=60)
+    for key in 'abc':
+        cache.put(key, 'x' * 40, {'results': {'bindings': [key]}}, 60)
+    assert list(cache.memory) == ['b', 'c'] and cache.memory_bytes == 80
+    assert cache.get('a') is None and cache.get('b')['results']['bindings'] == ['b']
+    cache.put('big', 'x' * 61, {'results': {'bindings': []}}, 60)
+    assert 'big' not in cache.memory and list(cache.memory) == ['c', 'b']
+    cache.put('c', 'x' * 10, {'results': {'bindings': ['c']}}, 60)
+    assert cache.memory_bytes == 50
+
+
+class StubQueryResponse:
+    status_code = 200
+    retries = 0
+    elapsed = datetime.timedelta(0)
+
+    def __init__(self, text):
+        self.text = text
+        self.content = text.encode()
+        self.raw = io.BytesIO()
+
+
+class WatchedFlights(dict):
+    """
+    In-flight requests that tell when a second caller found the request it waits for.
+    """
+    def __init__(self):
+        super().__init__()
+        self.joined = threading.Event()
+
+    def get(self, key, default=None):
+        flight = super().get(key, default)
+        if flight is not None:
+            self.joined.set()
+        return flight
+
+
+@pytest.fixture
+def coalescing(monkeypatch):
+    """
+    Stubs send_query with one that blocks each request until release() is called with what it should do.
+    Yields the sent queries, release, events set once a query is sent and once a second caller joined it,
+    and the query records.
+    """
+    flights = WatchedFlights()
+    monkeypatch.setattr(w, '_in_flight', flights)
+    outcomes = queue.Queue()
+    sent = []
+    sending = threading.Event()
+
+    def send_query(query, stream=False, deadline=None):
+        sent.append(query)
+        sending.set()
+        outcome = outcomes.get(timeout=5)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return StubQueryResponse(bindings_response(outcome).decode())
+
+    monkeypatch.setattr(w, 'send_query', send_query)
+    records = []
+    hook = w.add_query_hook(records.append)
+    yield sent, outcomes.put, sending, flights.joined, records
+    w.query_hooks.remove(hook)
+
+
+def call_in_thread(function, *args, **kwargs):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = function(*args, **kwargs)
+        except Exception as error:
+            outcome['error'] = error
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def test_coalescing_shares_the_result(coalescing):
+    sent, release, sending, joined, records = coalescing
+    first, first_outcome = call_in_thread(w.get_results_request, 'SELECT ?shared', use_cache=False)
+    assert sending.wait(5) and not joined.is_set()
+    second, second_outcome = call_in_thread(w.get_results_request, 'SELECT ?shared', use_cache=False)
+    assert joined.wait(5)
+    release(bindings[:2])
+    first.join(5)
+    second.join(5)
+    assert len(sent) == 1
+    assert first_outcome['result'] is second_outcome['result']
+    assert sorted(record['cache'] for record in records) == ['off', 'shared']
+
+
+def test_coalescing_shares_the_error(coalescing):
+    sent, release, sending, joined, records = coalescing
+    first, first_outcome = call_in_thread(w.get_results_request, 'SELECT ?failing', use_cache=False)
+    assert sending.wait(5)
+    second, second_outcome = call_in_thread(w.get_results_request, 'SELECT ?failing', use_cache=False)
+    assert joined.wait(5)
+    error = w.requests.HTTPError('500 Server Error')
+    release(error)
+    first.join(5)
+    second.join(5)
+    assert len(sent) == 1
+    assert first_outcome['error'] is error and second_outcome['error'] is error
+
+
+def test_coalescing_sends_again_after_the_sender_gave_up(coalescing):
+    sent, release, sending, joined, records = coalescing
+    first, first_outcome = call_in_thread(w.get_results_request, 'SELECT ?retried', use_cache=False, timeout=30)
+    assert sending.wait(5)
+    second, second_outcome = call_in_thread(w.get_results_request, 'SELECT ?retried', use_cache=False)
+    assert joined.wait(5)
+    release(w.requests.Timeout('deadline of the first caller'))  # cancels the shared request
+    release(bindings[:1])  # answers the second caller's own request
+    first.join(5)
+    second.join(5)
+    assert len(sent) == 2
+    assert isinstance(first_outcome['error'], w.requests.Timeout)
+    assert second_outcome['result']['results']['bindings'] == bindings[:1]
+    assert [record['cache'] for record in records] == ['off', 'off']
@@ -1,21 +1,705 @@
+import importlib
+import io
+import bisect
+import codecs
+import csv
+import heapq
 import itertools
+import os
+import pathlib
+import re
+import random
 import sys
+import tempfile
 import threading
 import time
-import requests
+import zlib
+from array import array
+from collections import OrderedDict, defaultdict
 import json
-import webbrowser
+
+
+class LazyModule:
+    """
+    Stands in for a module and imports it on first attribute access, keeps modules that only some code paths
+    need (the HTTP stack, sqlite, the browser) out of the start up time.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+argparse = LazyModule('argparse')
+email_utils = LazyModule('email.utils')
+futures = LazyModule('concurrent.futures')
+hashlib = LazyModule('hashlib')
+html = LazyModule('html')
+requests = LazyModule('requests')
+sqlite3 = LazyModule('sqlite3')
+webbrowser = LazyModule('webbrowser')
 
 endpoint_url = "https://query.wikidata.org/sparql"
+entity_prefix = "http://www.wikidata.org/entity/"
+
+# currencies offered for box office rankings: code -> (entity ID, label)
+currencies = {'USD': ('Q4917', 'United States dollar'), 'EUR': ('Q4916', 'euro'), 'GBP': ('Q25224', 'pound sterling'),
+              'JPY': ('Q8146', 'Japanese yen'), 'CHF': ('Q25344', 'Swiss franc'), 'INR': ('Q80524', 'Indian rupee')}
+
+film_id_genre_dict = {1: ('action film', 'Q188473'), 2: ('adventure film', 'Q319221'), 3: ('drama film', 'Q130232'),
+                      4: ('comedy film', 'Q157443'), 5: ('documentary film', 'Q93204'),
+                      6: ('thriller film', 'Q2484376'),
+                      7: ('romance film', 'Q1054574')}
 user_agent = "UZH_SemanticWeb_CourseProject/%s.%s" % (sys.version_info[0], sys.version_info[1])
 
+# transport settings, endpoint aborts queries after 60 seconds so read timeout is slightly above that
+connect_timeout = 5
+read_timeout = 65
+pool_size = 10
+max_retries = 4
+backoff_factor = 1.0  # waits 1, 2, 4, 8... seconds between retries unless endpoint sends Retry-After
+max_backoff = 60  # longest wait before a retry, a longer Retry-After fails the query instead
+retry_status_codes = (429, 500, 502, 503, 504)
+requests_per_second = 5  # client-side limit, query service allows only a few parallel queries per user agent
+genre_page_size = 100  # films per QUERY 1 page, the menu shows 10 at a time
+genre_page_window = 5  # pages of a genre listing kept in memory
+batch_size = 100  # films per VALUES block in batch queries, keeps each query well below the 60 second limit
+batch_max_chars = 4000
+max_get_length = 6000  # longer queries are sent as POST body, the endpoint rejects very long URLs
+stats_refresh_interval = 6 * 3600  # genre stats older than this are refreshed for changed films
+stats_batch_size = 500
+analytics_window = 2  # chunks of per-film queries running ahead while the analytics report is written
+profile_parse = os.environ.get('WIKIDATA_FILMS_PROFILE') == '1'  # cProfile and tracemalloc around JSON parsing
+max_parallel_queries = 4  # query service allows 5 concurrent queries per client, leave one for the main thread
+
+# result cache settings, wikidata changes slowly so genre-wide results can be kept for hours
+cache_dir = os.environ.get('WIKIDATA_FILMS_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'wikidata_films'))
+cache_max_bytes = 256 * 1024 * 1024
+memory_cache_size = 32  # number of parsed results kept in memory in front of the disk cache
+# response bytes of the parsed results kept in memory, parsed they take a few times more
+memory_cache_max_bytes = 64 * 1024 * 1024
+memory_cache_max_entry = 8 * 1024 * 1024  # larger results are only kept on disk
+cache_ttls = {'genre': 12 * 3600,  # QUERY 1 and the genre stats
+              'search': 3600,  # QUERY 2 and 3, user input so rarely repeated
+              'film': 24 * 3600,  # QUERY 4-7, facts about a single film
+              'classes': 7 * 24 * 3600,  # subclasses of film, refreshed weekly
+              'default': 3600}
+
+stream_chunk_size = 64 * 1024
+map_cluster_radius = 40  # pixels, markers closer than this on screen are drawn as one cluster
+result_formats = {'json': 'application/sparql-results+json', 'csv': 'text/csv', 'tsv': 'text/tab-separated-values'}
+
+_session = None
+_session_lock = threading.Lock()
+_cache = None
+_cache_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+_stats = None
+_stats_lock = threading.Lock()
+_film_classes = None  # (entity IDs of film and its subclasses, time fetched)
+_film_classes_lock = threading.Lock()
+film_classes_retry = 300  # seconds until a failed fetch of the film subclasses is tried again
+_profile_lock = threading.Lock()
+_in_flight = {}  # cache key -> Future of the request currently sent for it, shared by identical queries
+_in_flight_lock = threading.Lock()
+
+# callables that receive one dict per query with its timings, size and cache outcome, see add_query_hook
+query_hooks = []
+
+
+class RateLimiter:
+    """
+    Token bucket that blocks callers so no more than rate requests per second are sent.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1  # may go negative, next caller waits for the refill
+        if wait > 0:
+            time.sleep(wait)
+
+
+rate_limiter = RateLimiter(requests_per_second)
+
+
+def get_session() -> 'requests.Session':
+    """
+    Returns the shared keep-alive session, created on first use so all queries reuse pooled connections.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'User-Agent': user_agent,
+                                    'Accept': 'application/sparql-results+json',
+                                    'Accept-Encoding': 'gzip, deflate'})
+            _session = session
+    return _session
+
+
+def retry_delay(response, attempt: int) -> float:
+    """
+    Seconds to wait before the next attempt, taken from Retry-After if present, exponential backoff otherwise.
+    Retry-After is returned as it is even above max_backoff, retrying earlier than asked counts as abuse.
+    """
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:  # Retry-After can also be an HTTP date
+                retry_at = email_utils.parsedate_to_datetime(retry_after).timestamp()
+                return max(0.0, retry_at - time.time())
+            except (TypeError, ValueError):
+                pass
+    # jitter so parallel clients that got throttled together do not retry together
+    return min(max_backoff, backoff_factor * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def send_query(query, params=None, stream=False, headers=None, deadline=None) -> 'requests.Response':
+    """
+    Sends a SPARQL query over the shared session, retrying on throttling, server errors and dropped connections.
+    deadline is a time.monotonic() value after which no further attempt is started.
+    """
+    session = get_session()
+    params = dict({'format': 'json', 'query': query}, **(params or {}))
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        timeout = read_timeout
+        if deadline is not None:
+            timeout = min(read_timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise requests.Timeout(f'query did not finish within its deadline after {attempt} attempts')
+        response = None
+        try:
+            if len(query) > max_get_length:
+                response = session.post(endpoint_url, data=params, headers=headers,
+                                        timeout=(connect_timeout, timeout), stream=stream)
+            else:
+                response = session.get(endpoint_url, params=params, headers=headers,
+                                       timeout=(connect_timeout, timeout), stream=stream)
+            if response.status_code not in retry_status_codes:
+                if not response.ok:
+                    response.close()  # give the streamed connection back to the pool
+                    response.raise_for_status()
+                response.retries = attempt  # read by the instrumentation
+                return response
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= max_retries:
+                raise
+        delay = retry_delay(response, attempt)
+        if response is not None:
+            response.close()  # give connection back to the pool before sleeping or giving up
+        if delay > max_backoff:  # only a Retry-After can ask for that long, give up instead of retrying early
+            raise requests.HTTPError(f'{response.status_code} {response.reason}: the query service asked to wait '
+                                     f'{delay:.0f} seconds, longer than max_backoff', response=response)
+        if attempt >= max_retries or (deadline is not None and time.monotonic() + delay >= deadline):
+            if response is None:
+                raise requests.Timeout(f'query did not finish within its deadline after {attempt + 1} attempts')
+            response.raise_for_status()
+        time.sleep(delay)
+        attempt += 1
+
+
+def normalize_query(query: str) -> str:
+    """
+    Removes comments and collapses whitespace outside of string literals and IRIs so equal queries compare equal.
+    """
+    out = []
+    quote = None
+    i = 0
+    while i < len(query):
+        char = query[i]
+        if quote:
+            out.append(char)
+            if char == '\\' and i + 1 < len(query):
+                out.append(query[i + 1])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+            out.append(char)
+        elif char == '<' and query.find('>', i) != -1 and not any(c.isspace() for c in query[i:query.find('>', i)]):
+            end = query.find('>', i)  # IRI, may contain '#'
+            out.append(query[i:end + 1])
+            i = end
+        elif char == '#':
+            while i < len(query) and query[i] != '\n':
+                i += 1
+            if out and out[-1] != ' ':
+                out.append(' ')
+            continue
+        elif char.isspace():
+            if out and out[-1] != ' ':
+                out.append(' ')
+        else:
+            out.append(char)
+        i += 1
+    return ''.join(out).strip()
+
+
+def cache_key(query: str) -> str:
+    """
+    Content address of a query, independent of comments and formatting.
+    """
+    text = query if isinstance(query, BoundQuery) else normalize_query(query)
+    return hashlib.sha256(f'{endpoint_url}\n{text}'.encode()).hexdigest()
+
+
+entity_id_pattern = re.compile(r'Q[1-9]\d*')
+
+
+def sparql_entity(value) -> str:
+    """
+    Validates a Wikidata item ID such as "Q42" (or "q42") and returns it as wd:Q42.
+    """
+    entity_id = str(value).strip().upper()
+    if not entity_id_pattern.fullmatch(entity_id):
+        raise ValueError(f'"{value}" is not a Wikidata entity ID')
+    return f'wd:{entity_id}'
+
+
+def sparql_entities(values) -> str:
+    """
+    Validates several entity IDs and returns them space separated for a VALUES block.
+    """
+    entities = ' '.join(sparql_entity(value) for value in values)
+    if not entities:
+        raise ValueError('no entity IDs given')
+    return entities
+
+
+def sparql_string(value) -> str:
+    """
+    Returns value as a quoted SPARQL string literal with quotes, backslashes and line breaks escaped.
+    """
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    escaped = escaped.replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+    return '"%s"' % ''.join(char for char in escaped if char >= ' ')
+
 
-def get_results_request(query):
+def sparql_integer(value) -> str:
+    """
+    Validates a non-negative integer such as a LIMIT.
+    """
+    if isinstance(value, bool) or int(value) != value or value < 0:
+        raise ValueError(f'"{value}" is not a non-negative integer')
+    return str(int(value))
+
+
+def sparql_pattern(value) -> str:
+    """
+    Graph pattern built by this module, e.g. by film_class_values, inserted as it is. Never user input.
+    """
+    return str(value)
+
+
+# how each kind of query parameter is validated and written into the query
+parameter_types = {'entity': sparql_entity, 'entities': sparql_entities, 'string': sparql_string,
+                   'integer': sparql_integer, 'pattern': sparql_pattern}
+
+prepared_queries = {}  # query name -> PreparedQuery, filled as the module defines its queries
+
+
+class BoundQuery(str):
+    """
+    Query text bound from a PreparedQuery. It is normalised already, so cache_key hashes it as it is.
+    """
+
+
+class PreparedQuery:
+    """
+    Query template with named %(name)s parameters, each with a type from parameter_types, registered in
+    prepared_queries under its name. Comments and whitespace are stripped once when the template is first bound,
+    bound values are validated and escaped by their type.
+    """
+    def __init__(self, name: str, template: str, **params):
+        if name in prepared_queries:
+            raise ValueError(f'a query named "{name}" is already prepared')
+        unknown = set(params.values()) - set(parameter_types)
+        if unknown:
+            raise ValueError(f'{name}: unknown parameter types {sorted(unknown)}')
+        self.name = name
+        self.template = template
+        self.params = params
+        self._text = None
+        prepared_queries[name] = self
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            text = normalize_query(self.template)
+            names = set(re.findall(r'%\((\w+)\)s', text))
+            if names != set(self.params):
+                raise ValueError(f'{self.name}: template parameters {sorted(names)} do not match {sorted(self.params)}')
+            self._text = text
+        return self._text
+
+    def bind(self, **values) -> BoundQuery:
+        if set(values) != set(self.params):
+            raise TypeError(f'{self.name} takes the parameters {", ".join(sorted(self.params))}')
+        return BoundQuery(self.text % {name: parameter_types[kind](values[name]) for name, kind in self.params.items()})
+
+
+class ResultCache:
+    """
+    Two tier cache for query results: in-memory LRU of parsed results in front of a sqlite file of raw responses.
+    The memory tier is limited by entries and by the response bytes of its results, large results skip it.
+    The sqlite file can be shared by several processes pointing at the same cache directory.
+    """
+    def __init__(self, path: str = None, max_bytes: int = cache_max_bytes, memory_size: int = memory_cache_size,
+                 memory_max_bytes: int = memory_cache_max_bytes, memory_max_entry: int = memory_cache_max_entry):
+        self.max_bytes = max_bytes
+        self.memory_size = memory_size
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_max_entry = memory_max_entry
+        self.memory = OrderedDict()  # key -> (expires, results, response bytes)
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+                self.db.execute('PRAGMA journal_mode=WAL')
+                self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, kind TEXT, body BLOB, '
+                                'size INTEGER, expires REAL, accessed REAL)')
+                self.db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            except (OSError, sqlite3.Error):
+                self.db = None  # read-only home directory etc., keep working with the memory tier only
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] > now:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return entry[1]
+            row = None
+            if self.db is not None:
+                try:
+                    row = self.db.execute('SELECT body, expires FROM results WHERE key = ? AND expires > ?',
+                                          (key, now)).fetchone()
+                    if row is not None:
+                        self.db.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+                except sqlite3.Error:
+                    row = None
+            if row is None:
+                self._forget(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            text = zlib.decompress(row[0])
+            results = json.loads(text)
+            self._remember(key, row[1], results, len(text))
+            return results
+
+    def put(self, key: str, text: str, results, ttl: float, kind: str = 'default'):
+        now = time.time()
+        data = text.encode()
+        body = zlib.compress(data, 6)
+        with self.lock:
+            self._remember(key, now + ttl, results, len(data))
+            if self.db is None:
+                return
+            try:
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                                (key, kind, body, len(body), now + ttl, now))
+                self._evict(now)
+            except sqlite3.Error:
+                pass
+
+    def _remember(self, key, expires, results, size):
+        self._forget(key)
+        if size > self.memory_max_entry:
+            return  # a few of these would fill the memory, they are read from disk each time
+        self.memory[key] = (expires, results, size)
+        self.memory_bytes += size
+        while len(self.memory) > self.memory_size or self.memory_bytes > self.memory_max_bytes:
+            self.memory_bytes -= self.memory.popitem(last=False)[1][2]
+
+    def _forget(self, key):
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry[2]
+
+    def _evict(self, now):
+        self.db.execute('DELETE FROM results WHERE expires <= ?', (now,))
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop least recently used entries until under the size cap
+        for key, size in self.db.execute('SELECT key, size FROM results ORDER BY accessed').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+            self._forget(key)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+            if self.db is not None:
+                self.db.execute('DELETE FROM results')
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'memory_hits': self.memory_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'memory_entries': len(self.memory), 'memory_bytes': self.memory_bytes}
+
+
+def get_cache() -> ResultCache:
+    """
+    Returns the shared result cache, opened on first use. Set cache_dir to None to keep results in memory only.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(os.path.join(cache_dir, 'results.sqlite3') if cache_dir else None)
+    return _cache
+
+
+def add_query_hook(hook):
+    """
+    Registers a callable that is called with a record of every query, e.g. a QueryMetrics or JsonLinesSink.
+    Records contain name, kind, cache ('hit', 'shared', 'miss' or 'off'), retries, bytes (on the wire), rows, status,
+    error and the timings in seconds: request (until the response headers including retries and waits),
+    ttfb (of the final attempt), download, parse and total.
+    """
+    query_hooks.append(hook)
+    return hook
+
+
+def emit_query_record(record: dict):
+    for hook in list(query_hooks):
+        try:
+            hook(record)
+        except Exception:  # instrumentation must never break a query
+            pass
+
+
+def parse_results(text: str, record: dict = None):
+    """
+    json.loads of a response, with cProfile and tracemalloc around it if profile_parse is set.
+    """
+    if not profile_parse or record is None:
+        return json.loads(text)
+    import cProfile
+    import pstats
+    import tracemalloc
+    with _profile_lock:  # one profiled parse at a time, tracemalloc peaks are process wide
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        try:
+            results = profiler.runcall(json.loads, text)
+        finally:
+            record['parse_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            if not tracing:
+                tracemalloc.stop()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(10)
+        record['parse_profile'] = report.getvalue()
+    return results
+
+
+def get_results_request(query, kind='default', use_cache=True, timeout=None, name='query'):
     """
     Gets the results from wikidata through a SPARQL query.
+    kind selects the cache lifetime from cache_ttls, use_cache=False forces a fresh request.
+    timeout limits the total seconds spent including retries, name identifies the query in the instrumentation.
+    Callers asking for a query that is already being sent wait for that request and share its result or error.
     """
-    req = requests.get(endpoint_url, params={'format': 'json', 'query': query}, headers={'User-Agent': user_agent}).text
-    return json.loads(req)
+    started = time.perf_counter()
+    deadline = time.monotonic() + timeout if timeout else None
+    cache = get_cache() if use_cache else None
+    sent = 'off' if cache is None else 'miss'
+    record = {'name': name, 'kind': kind, 'cache': sent, 'retries': 0, 'bytes': 0, 'rows': 0, 'status': None,
+              'error': None}
+    try:
+        key = cache_key(query)
+        while True:
+            if cache is not None:
+                results = cache.get(key)
+                if results is not None:
+                    record['cache'] = 'hit'
+                    record['rows'] = len(results['results']['bindings'])
+                    return results
+            with _in_flight_lock:
+                flight = _in_flight.get(key)
+                if flight is None:
+                    flight = _in_flight[key] = futures.Future()
+                    break
+            # the same query is already on its way, wait for it instead of sending it again
+            record['cache'] = 'shared'
+            try:
+                results = flight.result(None if deadline is None else max(deadline - time.monotonic(), 0))
+            except futures.CancelledError:
+                record['cache'] = sent  # the sender gave up for its own reasons, e.g. its deadline, send it ourselves
+                continue
+            except futures.TimeoutError:
+                raise requests.Timeout('query did not finish within its deadline') from None
+            record['rows'] = len(results['results']['bindings'])
+            return results
+
+        try:
+            response = send_query(query, stream=True, deadline=deadline)
+            received = time.perf_counter()
+            text = response.text
+            downloaded = time.perf_counter()
+            record.update(status=response.status_code, retries=response.retries, request=received - started,
+                          ttfb=response.elapsed.total_seconds(), download=downloaded - received,
+                          bytes=response.raw.tell() or len(response.content))
+            results = parse_results(text, record)
+            record['parse'] = time.perf_counter() - downloaded
+            record['rows'] = len(results['results']['bindings'])
+            if cache is not None:
+                cache.put(key, text, results, cache_ttls.get(kind, cache_ttls['default']), kind)
+        except requests.Timeout as error:
+            # a timeout of our own deadline says nothing about the query, the waiting callers retry it
+            if deadline is None:
+                flight.set_exception(error)
+            else:
+                flight.cancel()
+            raise
+        except Exception as error:
+            flight.set_exception(error)
+            raise
+        except BaseException:
+            flight.cancel()  # interrupted, e.g. KeyboardInterrupt
+            raise
+        else:
+            flight.set_result(results)
+        finally:
+            with _in_flight_lock:
+                _in_flight.pop(key, None)
+        return results
+    except Exception as error:
+        record['error'] = type(error).__name__
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            record['status'] = error.response.status_code
+        raise
+    finally:
+        record['total'] = time.perf_counter() - started
+        if query_hooks:
+            emit_query_record(record)
+
+
+class QueryMetrics:
+    """
+    Aggregates query records into histograms per query name, exported in the Prometheus text format.
+    """
+    second_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    size_buckets = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+    phases = ('request', 'ttfb', 'download', 'parse', 'total')
+
+    def __init__(self):
+        self.histograms = {}  # (metric, labels) -> [bucket counts..., sum, count]
+        self.counters = defaultdict(int)  # (metric, labels) -> value
+        self.lock = threading.Lock()
+
+    def _observe(self, metric, labels, buckets, value):
+        histogram = self.histograms.setdefault((metric, labels), [0] * (len(buckets) + 2))
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def __call__(self, record: dict):
+        name = record['name']
+        with self.lock:
+            self.counters[('wikidata_queries_total', (('query', name), ('cache', record['cache'])))] += 1
+            self.counters[('wikidata_query_retries_total', (('query', name),))] += record['retries']
+            if record['error']:
+                self.counters[('wikidata_query_errors_total', (('query', name), ('error', record['error'])))] += 1
+            for phase in self.phases:
+                if record.get(phase) is not None:
+                    self._observe('wikidata_query_seconds', (('query', name), ('phase', phase)),
+                                  self.second_buckets, record[phase])
+            if record['cache'] not in ('hit', 'shared') and not record['error']:
+                self._observe('wikidata_query_bytes', (('query', name),), self.size_buckets, record['bytes'])
+            self._observe('wikidata_query_rows', (('query', name),), self.size_buckets, record['rows'])
+
+    def prometheus(self) -> str:
+        def labels_text(labels, extra=()):
+            return ','.join(f'{key}="{value}"' for key, value in labels + extra)
+
+        lines = []
+        with self.lock:
+            for metric in sorted({metric for metric, _ in self.counters}):
+                lines.append(f'# TYPE {metric} counter')
+                lines.extend(f'{metric}{{{labels_text(labels)}}} {value}'
+                             for (name, labels), value in sorted(self.counters.items()) if name == metric)
+            for metric in sorted({metric for metric, _ in self.histograms}):
+                buckets = self.second_buckets if metric == 'wikidata_query_seconds' else self.size_buckets
+                lines.append(f'# TYPE {metric} histogram')
+                for (name, labels), histogram in sorted(self.histograms.items()):
+                    if name != metric:
+                        continue
+                    for bound, count in zip(buckets, histogram):
+                        lines.append(f'{metric}_bucket{{{labels_text(labels, (("le", bound),))}}} {count}')
+                    lines.append(f'{metric}_bucket{{{labels_text(labels, (("le", "+Inf"),))}}} {histogram[-1]}')
+                    lines.append(f'{metric}_sum{{{labels_text(labels)}}} {histogram[-2]}')
+                    lines.append(f'{metric}_count{{{labels_text(labels)}}} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        with open(path, 'w', encoding='utf-8') as out:
+            out.write(self.prometheus())
+
+
+class JsonLinesSink:
+    """
+    Appends every query record as one JSON line to a file.
+    """
+    def __init__(self, path: str):
+        self.out = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def __call__(self, record: dict):
+        line = json.dumps(dict(record, time=time.time()), ensure_ascii=False)
+        with self.lock:
+            self.out.write(line + '\n')
+            self.out.flush()
+
+    def close(self):
+        self.out.close()
 
 
 def input_checker(inp: str, start: int = 1, stop: int = 7) -> int:
@@ -38,6 +722,19 @@ def input_checker(inp: str, start: int = 1, stop: int = 7) -> int:
     return inp
 
 
+query_2 = PreparedQuery('QUERY 2', """
+    SELECT ?film ?filmLabel 
+    WHERE 
+    {
+      VALUES ?film {%(film)s} # set film variable using ID provided by user
+      %(classes)s # film and all its subclasses
+      ?film wdt:P31 ?class; # make sure this ID belongs to film
+            wdt:P136 %(genre)s. # make sure it belongs to previously selected genre
+      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+    }
+""", film='entity', classes='pattern', genre='entity')
+
+
 def find_by_id(genre_str, genre_id):
     """
     Finds Wikidata entity through its entity ID given by the user.
@@ -48,20 +745,17 @@ def find_by_id(genre_str, genre_id):
     i_3 = input('\nEnter an Entity ID:\n'
                 '>> ').rstrip()
 
+    try:
+        sparql_entity(i_3)
+    except ValueError:  # not an entity ID at all, do not ask the endpoint
+        print(f'\n"{i_3}" is not an ID for any {genre_str}, try something else.')
+        return i_4, i_3, item_label
+
     try:
         # QUERY 2: find film by ID
-        query = """
-        SELECT ?film ?filmLabel 
-        WHERE 
-        {
-          VALUES ?film {wd:%s} # set film variable using ID provided by user
-          ?film wdt:P31/wdt:P279* wd:Q11424; # make sure this ID belongs to film
-                wdt:P136 wd:%s. # make sure it belongs to previously selected genre
-          SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-        }
-        """ % (i_3, genre_id)
+        query = query_2.bind(film=i_3, classes=film_class_values(), genre=genre_id)
 
-        results = get_results_request(query)
+        results = get_results_request(query, 'search', name='QUERY 2')
 
         entity_id = results['results']['bindings'][0]['film']['value'][31:]
         item_label = results['results']['bindings'][0]['filmLabel']['value']
@@ -76,9 +770,22 @@ def find_by_id(genre_str, genre_id):
     return i_4, i_3, item_label
 
 
-def find_by_string(genre_str, genre_id):
+query_3 = PreparedQuery('QUERY 3', """
+    SELECT ?film ?filmLabel
+    WHERE{
+    ?film wdt:P31 wd:Q11424;
+            wdt:P136 %(genre)s; # make sure film belongs to specified genre
+            rdfs:label ?filmLabel. # get labels
+    FILTER(LANG(?filmLabel) ="en"). # only get english labels
+    FILTER (CONTAINS(LCASE(STR(?filmLabel)), %(text)s))  # check if user input is somewhere in label
+    } LIMIT 1 # return only one out of all that contain this string
+""", genre='entity', text='string')
+
+
+def find_by_string(genre_str, genre_id, index=None):
     """
     Finds Wikidata entity that contains the string given by the user.
+    Looks in the local LabelIndex of the genre first and only queries wikidata if nothing is found there.
     """
     i_4 = 2
     entity_id = ''
@@ -87,19 +794,18 @@ def find_by_string(genre_str, genre_id):
     i_3 = input('\nEnter the Label (Name) of the film:\n'
                 '>> ').lower()
 
+    matches = index.search(i_3, 1) if index is not None and i_3 else []
+    if matches:
+        entity_id, item_label = matches[0]
+        i_4 = input_checker(input(f'\nDid you mean "{item_label}" with Entity ID "{entity_id}"?:\n'
+                                  f'[1] yes [2] no\n'
+                                  f'>> '), 1, 2)
+        return i_4, entity_id, item_label
+
     # QUERY 3: find labels that contain user given input, return first
-    query = """
-    SELECT ?film ?filmLabel
-    WHERE{
-    ?film wdt:P31 wd:Q11424;
-            wdt:P136 wd:%s; # make sure film belongs to specified genre
-            rdfs:label ?filmLabel. # get labels
-    FILTER(LANG(?filmLabel) ="en"). # only get english labels
-    FILTER (CONTAINS(LCASE(STR(?filmLabel)), "%s"))  # check if user input is somewhere in label
-    } LIMIT 1 # return only one out of all that contain this string
-    """ % (genre_id, i_3)
+    query = query_3.bind(genre=genre_id, text=i_3)
 
-    results = get_results_request(query)
+    results = get_results_request(query, 'search', name='QUERY 3')
 
     try:
         entity_id = results['results']['bindings'][0]['film']['value'][31:]
@@ -115,19 +821,1443 @@ def find_by_string(genre_str, genre_id):
     return i_4, entity_id, item_label
 
 
+class QueryExecutor:
+    """
+    Runs SPARQL queries concurrently on a bounded thread pool.
+    Queries not started yet can be cancelled, running ones stop at their timeout.
+    """
+    def __init__(self, max_workers: int = max_parallel_queries):
+        self.pool = futures.ThreadPoolExecutor(max_workers, thread_name_prefix='sparql')
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def submit(self, query, kind='default', timeout=None, name='query'):
+        return self.call(get_results_request, query, kind, True, timeout, name)
+
+    def call(self, function, *args):
+        """
+        Runs any function that sends queries on the pool, e.g. to fetch and convert a page of results.
+        """
+        future = self.pool.submit(function, *args)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def submit_all(self, queries: dict, kind='default', timeout=None, names=None) -> dict:
+        names = names or {}
+        return {key: self.submit(query, kind, timeout, names.get(key, 'query')) for key, query in queries.items()}
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def cancel(self):
+        """
+        Cancels all queries that are still waiting for a free worker.
+        """
+        with self.lock:
+            pending = list(self.pending)
+        for future in pending:
+            future.cancel()
+
+    def shutdown(self, wait=True):
+        self.cancel()
+        self.pool.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+def get_executor() -> QueryExecutor:
+    """
+    Returns the shared query executor, created on first use.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = QueryExecutor()
+    return _executor
+
+
+_bindings_start = re.compile(r'"bindings"\s*:\s*\[')
+
+
+def iter_json_bindings(chunks):
+    """
+    Incrementally parses SPARQL JSON results from byte chunks and yields each binding as soon as it is complete,
+    without holding the whole response text or result tree in memory.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    started = False
+    for chunk in itertools.chain(chunks, [None]):
+        buffer += utf8.decode(chunk or b'', final=chunk is None)
+        if not started:
+            match = _bindings_start.search(buffer)
+            if match is None:
+                continue
+            started = True
+            buffer = buffer[match.end():]
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                binding, pos_end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break  # binding not complete yet, wait for the next chunk
+            pos = pos_end
+            yield binding
+        buffer = buffer[pos:]
+        if chunk is None and buffer.strip():
+            raise ValueError('SPARQL result stream ended inside the bindings list')
+
+
+def parse_tsv_term(term: str) -> dict:
+    """
+    Turns an RDF term of the SPARQL TSV format into the binding dict used by the JSON format.
+    """
+    if term.startswith('<') and term.endswith('>'):
+        return {'type': 'uri', 'value': term[1:-1]}
+    if term.startswith('"'):
+        end = term.rfind('"')
+        value = term[1:end].replace('\\"', '"').replace('\\t', '\t').replace('\\n', '\n').replace('\\\\', '\\')
+        binding = {'type': 'literal', 'value': value}
+        suffix = term[end + 1:]
+        if suffix.startswith('@'):
+            binding['xml:lang'] = suffix[1:]
+        elif suffix.startswith('^^<'):
+            binding['datatype'] = suffix[3:-1]
+        return binding
+    return {'type': 'literal', 'value': term}  # bare numbers and booleans
+
+
+def iter_text_lines(chunks):
+    """
+    Decodes UTF-8 byte chunks and yields the text line by line with its line ending, also when a line
+    ending or a character is split across two chunks.
+    """
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    for chunk in itertools.chain(chunks, [None]):
+        buffer += utf8.decode(chunk or b'', final=chunk is None)
+        lines = buffer.split('\n')
+        buffer = lines.pop()  # \r of a \r\n stays with its line until the \n arrives
+        for line in lines:
+            yield line + '\n'
+    if buffer:
+        yield buffer
+
+
+def iter_response_bindings(response, fmt='json'):
+    """
+    Yields the bindings of a streamed response in the JSON shape, whatever result format was requested.
+    """
+    if fmt == 'json':
+        yield from iter_json_bindings(response.iter_content(stream_chunk_size))
+        return
+    # not response.iter_lines, it yields an extra empty line when a \r\n is split across chunks
+    lines = iter_text_lines(response.iter_content(stream_chunk_size))
+    if fmt == 'tsv':
+        rows = csv.reader(lines, delimiter='\t', quoting=csv.QUOTE_NONE)
+    else:
+        rows = csv.reader(lines)
+    header = [var.lstrip('?') for var in next(rows, [])]
+    for row in rows:
+        if not row:
+            continue
+        if fmt == 'tsv':
+            yield {var: parse_tsv_term(value) for var, value in zip(header, row) if value}
+        else:
+            yield {var: {'value': value} for var, value in zip(header, row) if value}
+
+
+def iter_results_request(query, fmt='json', kind='default', use_cache=True, name='query'):
+    """
+    Streams the bindings of a SPARQL query while the response is still downloading.
+    fmt 'csv' or 'tsv' asks the endpoint for the cheaper tabular formats, bindings keep the JSON shape
+    ({'var': {'value': ...}}) so callers do not need to care which format was used.
+    With use_cache JSON results are read from and written to the result cache, which means the bindings are
+    collected once the stream is finished; use_cache=False keeps memory flat for very large results.
+    The instrumentation record has no separate parse time, parsing happens during the download.
+    """
+    started = time.perf_counter()
+    cache = get_cache() if use_cache and fmt == 'json' else None
+    record = {'name': name, 'kind': kind, 'cache': 'off' if cache is None else 'miss', 'retries': 0, 'bytes': 0,
+              'rows': 0, 'status': None, 'error': None}
+    response = None
+    try:
+        key = cache_key(query)
+        if cache is not None:
+            results = cache.get(key)
+            if results is not None:
+                record['cache'] = 'hit'
+                for record['rows'], binding in enumerate(results['results']['bindings'], 1):
+                    yield binding
+                return
+        response = send_query(query, params={'format': 'json' if fmt == 'json' else None}, stream=True,
+                              headers={'Accept': result_formats[fmt]})
+        received = time.perf_counter()
+        record.update(status=response.status_code, retries=response.retries, request=received - started,
+                      ttfb=response.elapsed.total_seconds())
+        collected = [] if cache is not None else None
+        for record['rows'], binding in enumerate(iter_response_bindings(response, fmt), 1):
+            if collected is not None:
+                collected.append(binding)
+            yield binding
+        record.update(download=time.perf_counter() - received, bytes=response.raw.tell())
+        if collected is not None:
+            results = {'results': {'bindings': collected}}
+            cache.put(key, json.dumps(results), results, cache_ttls.get(kind, cache_ttls['default']), kind)
+    except Exception as error:
+        record['error'] = type(error).__name__
+        raise
+    finally:
+        if response is not None:
+            response.close()
+        record['total'] = time.perf_counter() - started
+        if query_hooks:
+            emit_query_record(record)
+
+
+class LabelIndex:
+    """
+    Trigram index over the labels of a FilmTable for substring and prefix search without a QUERY 3 round-trip.
+    Rows appended to the table later (e.g. while QUERY 1 is still streaming) are indexed on the next search.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.lowered = []  # lower case label per row
+        self.grams = defaultdict(lambda: array('I'))  # trigram -> rows whose label contains it
+        self.sorted = []  # (lower case label, row) in label order for prefix lookups
+        self.lock = threading.Lock()
+
+    def update(self):
+        with self.lock:
+            added = len(self.table) - len(self.lowered)
+            for row in range(len(self.lowered), len(self.table)):
+                label = self.table.label(row).lower()
+                self.lowered.append(label)
+                self.sorted.append((label, row))
+                for gram in {label[i:i + 3] for i in range(len(label) - 2)}:
+                    self.grams[gram].append(row)
+            if added > 0:
+                self.sorted.sort()  # new rows are a sorted run at the end, cheap for timsort
+
+    def prefixed(self, text: str, k: int) -> list:
+        start = bisect.bisect_left(self.sorted, (text,))
+        return [row for label, row in self.sorted[start:start + k] if label.startswith(text)]
+
+    def candidates(self, text: str):
+        if len(text) < 3:
+            return range(len(self.lowered))
+        postings = sorted((self.grams.get(text[i:i + 3], ()) for i in range(len(text) - 2)), key=len)
+        rows = set(postings[0])
+        for posting in postings[1:]:
+            if not rows:
+                break
+            rows.intersection_update(posting)
+        return rows
+
+    def search(self, text: str, k: int = 10) -> list:
+        """
+        Returns up to k (entity ID, label) pairs whose label contains text, best matches first:
+        exact match, then prefix, then match at a word start, then earlier and shorter labels.
+        If at least k labels start with text these are taken in alphabetical order without a full scan.
+        """
+        self.update()
+        text = text.lower()
+        rows = self.prefixed(text, k)
+        if len(rows) < k:  # not enough prefix matches, look for the text anywhere in the labels
+            rows = self.candidates(text)
+        ranked = []
+        for row in rows:
+            label = self.lowered[row]
+            position = label.find(text)
+            if position == -1:
+                continue
+            word_start = position == 0 or not label[position - 1].isalnum()
+            ranked.append(((label != text, position != 0, not word_start, position, len(label), row), row))
+        return [(self.table.entity_id(row), self.table.label(row)) for _, row in heapq.nsmallest(k, ranked)]
+
+
+def to_int(value: str) -> int:
+    """
+    Parses a numeric literal, amounts are sometimes given in scientific notation.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+class StringTable:
+    """
+    Stores many short strings in one str, string i is text[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self):
+        self.offsets = array('L', [0])
+        self.chunks = []
+        self.text = ''
+
+    def append(self, value: str):
+        self.chunks.append(value)
+        self.offsets.append(self.offsets[-1] + len(value))
+
+    def __getitem__(self, index: int) -> str:
+        pending = len(self.chunks)
+        if pending:  # join strings appended since the last lookup, appends may continue from another thread
+            self.text += ''.join(self.chunks[:pending])
+            del self.chunks[:pending]
+        return self.text[self.offsets[index]:self.offsets[index + 1]]
+
+
+class FilmTable:
+    """
+    Column store for film result sets. QIDs are kept as integers in an array('I'), labels in a single string
+    table addressed by offsets and numeric variables (box office, cost, award count...) in array('q') columns.
+    Slicing returns a view on the same columns, so paging does not copy or re-walk any rows.
+    """
+    def __init__(self, numeric=()):
+        self.ids = array('I')
+        self.labels = StringTable()
+        self.columns = {name: array('q') for name in numeric}
+        self.start = 0
+        self.stop = None  # None for the full, still growing table
+
+    @classmethod
+    def from_bindings(cls, bindings, numeric=()):
+        table = cls(numeric)
+        for binding in bindings:
+            table.append(binding)
+        return table
+
+    def append(self, binding: dict):
+        if self.stop is not None:
+            raise TypeError('cannot append to a slice of a FilmTable')
+        entity_id = binding['film']['value'][len(entity_prefix) + 1:]  # strip prefix and the "Q"
+        label = binding['filmLabel']['value'] if 'filmLabel' in binding else ''
+        self.labels.append(label)
+        for name, column in self.columns.items():
+            column.append(to_int(binding[name]['value']) if name in binding else 0)
+        self.ids.append(int(entity_id))  # last, the length of ids makes the row visible to readers
+
+    def _view(self, start, stop):
+        view = object.__new__(FilmTable)
+        view.__dict__.update(self.__dict__)
+        view.start, view.stop = start, stop
+        return view
+
+    def _end(self):
+        return len(self.ids) if self.stop is None else self.stop
+
+    def __len__(self):
+        return self._end() - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('FilmTable only supports contiguous slices')
+            return self._view(self.start + start, self.start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('FilmTable index out of range')
+        return self.entity_id(index), self.label(index)
+
+    def __iter__(self):
+        return self.rows()
+
+    def entity_id(self, index: int) -> str:
+        return f'Q{self.ids[self.start + index]}'
+
+    def label(self, index: int) -> str:
+        return self.labels[self.start + index] or self.entity_id(index)
+
+    def extend(self, other: 'FilmTable'):
+        """
+        Appends all rows of another table (or view) with the columns both tables have.
+        """
+        for index in range(len(other)):
+            row = other.start + index
+            self.labels.append(other.labels[row])
+            for name, column in self.columns.items():
+                column.append(other.columns[name][row] if name in other.columns else 0)
+            self.ids.append(other.ids[row])
+
+    def rows(self, *names):
+        """
+        Yields (entity ID, label, *numeric values) for every film in the table.
+        """
+        columns = [self.columns[name] for name in names]
+        for index in range(len(self)):
+            row = self.start + index
+            yield (self.entity_id(index), self.label(index)) + tuple(column[row] for column in columns)
+
+
+class GenrePages:
+    """
+    Films of a genre fetched page by page with keyset pagination instead of one unbounded QUERY 1.
+    The page after the last one used is fetched in the background and only the most recently used pages are
+    kept, so time to the first row and memory do not depend on the size of the genre.
+    Slicing returns a FilmTable like slicing a full listing would.
+    """
+    def __init__(self, genre_id, page_size=genre_page_size, window=genre_page_window, executor=None):
+        self.genre_id = genre_id
+        self.page_size = page_size
+        self.window = window
+        self.executor = executor or get_executor()
+        self.pages = OrderedDict()  # page number -> future of its FilmTable
+        self.after = {0: ''}  # page number -> URI of the last film of the previous page
+        self.last_page = None  # known once a page comes back short
+        self.films = FilmTable()  # every film seen so far, compact, e.g. for a LabelIndex
+        self.seen_pages = 0
+        self.lock = threading.Lock()
+
+    def _fetch(self, number) -> FilmTable:
+        query = genre_films_page_query(self.genre_id, self.after[number], self.page_size)
+        table = FilmTable.from_bindings(get_results_request(query, 'genre', name='QUERY 1')['results']['bindings'])
+        with self.lock:
+            if len(table) < self.page_size:
+                self.last_page = number
+            elif number + 1 not in self.after:
+                self.after[number + 1] = entity_prefix + table.entity_id(len(table) - 1)
+            if number == self.seen_pages:  # pages are fetched in order, refetched pages are already known
+                self.films.extend(table)
+                self.seen_pages += 1
+        return table
+
+    def _future(self, number):
+        with self.lock:
+            if number in self.pages:
+                self.pages.move_to_end(number)
+                return self.pages[number]
+            future = self.executor.call(self._fetch, number)
+            self.pages[number] = future
+            while len(self.pages) > self.window:
+                self.pages.popitem(last=False)
+            return future
+
+    def page(self, number: int) -> FilmTable:
+        """
+        Returns one page, fetching earlier pages first if their last film is not known yet.
+        """
+        for previous in range(number):
+            if previous + 1 in self.after:
+                continue
+            if self.last_page is not None and previous >= self.last_page:
+                break
+            self._future(previous).result()
+        if number not in self.after:
+            return FilmTable()  # past the last page
+        table = self._future(number).result()
+        if self.last_page is None or number < self.last_page:
+            self._future(number + 1)  # prefetch, the user will most likely ask for more
+        return table
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.start is None or index.stop is None:
+            raise TypeError('GenrePages only supports slices with start and stop')
+        rows = FilmTable()
+        for number in range(index.start // self.page_size, (index.stop - 1) // self.page_size + 1):
+            first = number * self.page_size
+            rows.extend(self.page(number)[max(index.start - first, 0):index.stop - first])
+        return rows
+
+
+query_film_classes = PreparedQuery('FILM CLASSES', """
+    SELECT ?class
+    WHERE {
+      ?class wdt:P279* wd:Q11424.
+    }
+""")
+
+
+def film_classes_query():
+    """
+    Film (Q11424) and all its subclasses, resolved once instead of walking wdt:P279* in every query.
+    """
+    return query_film_classes.bind()
+
+
+def film_classes() -> tuple:
+    """
+    Returns the sorted entity IDs of film and all its subclasses, fetched on first use and again once they are
+    older than cache_ttls['classes']. Returns an empty tuple while they cannot be fetched.
+    """
+    global _film_classes
+    with _film_classes_lock:
+        if _film_classes is None or time.time() - _film_classes[1] > cache_ttls['classes']:
+            try:
+                results = get_results_request(film_classes_query(), 'classes', name='FILM CLASSES')
+                classes = {binding['class']['value'][len(entity_prefix):] for binding in results['results']['bindings']}
+                _film_classes = (tuple(sorted(classes, key=lambda entity_id: int(entity_id[1:]))), time.time())
+            except (requests.RequestException, ValueError, KeyError):
+                # keep what we had, or the property path for now, and try again a bit later
+                previous = _film_classes[0] if _film_classes else ()
+                _film_classes = (previous, time.time() - cache_ttls['classes'] + film_classes_retry)
+        return _film_classes[0]
+
+
+def film_class_values() -> str:
+    """
+    Binds ?class to film and each of its subclasses so queries can match films with ?film wdt:P31 ?class.
+    Falls back to the property path if the subclasses are not available.
+    """
+    classes = film_classes()
+    if not classes:
+        return '?class wdt:P279* wd:Q11424.'
+    return 'VALUES ?class {%s}' % ' '.join(f'wd:{entity_id}' for entity_id in classes)
+
+
+query_1 = PreparedQuery('QUERY 1', """
+    SELECT ?film ?filmLabel
+    WHERE {
+    %(classes)s # film and all its subclasses
+    ?film wdt:P31 ?class; # variable is instance/subclass of film
+          wdt:P136 %(genre)s. # variable film has certain genre
+    SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+    }
+""", classes='pattern', genre='entity')
+
+
+def genre_films_query(genre_id):
+    """
+    QUERY 1: all films that belong to a genre.
+    """
+    # look for all instances/subclasses of film and show the ones that have the selected genre as property
+    # this string formatting method instead f-string as brackets are present;
+    # no LIMIT on purpose to get everything without additional requests if user requests;
+    return query_1.bind(classes=film_class_values(), genre=genre_id)
+
+
+query_1_page = PreparedQuery('QUERY 1 page', """
+    SELECT ?film ?filmLabel
+    WHERE {
+      {
+        SELECT DISTINCT ?film
+        WHERE {
+          %(classes)s # film and all its subclasses
+          ?film wdt:P31 ?class; # variable is instance/subclass of film
+                wdt:P136 %(genre)s. # variable film has certain genre
+          FILTER(STR(?film) > %(after)s) # keyset pagination, continue after last film of previous page
+        }
+        ORDER BY STR(?film)
+        LIMIT %(limit)s
+      }
+      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+    }
+    ORDER BY STR(?film) # the label service does not keep the order of the page
+""", classes='pattern', genre='entity', after='string', limit='integer')
+
+
+def genre_films_page_query(genre_id, after='', limit=genre_page_size):
+    """
+    QUERY 1 as a single page: films of a genre ordered by URI, starting after the URI given by after.
+    Only the films of the page are labelled, the subquery selects them before the label service runs.
+    """
+    return query_1_page.bind(
+        classes=film_class_values(), genre=genre_id, after=after, limit=limit)
+
+
+query_stats_films = PreparedQuery('STATS films', """
+    SELECT ?film ?modified (COUNT(DISTINCT ?award) AS ?awards) (MIN(YEAR(?date)) AS ?year)
+    WHERE {
+      %(selector)s
+      ?film schema:dateModified ?modified. # to find films that changed since the last refresh
+      OPTIONAL {
+        { ?film wdt:P166 ?award. } # awards of a film
+        UNION # one row per award or date instead of every award with every date
+        { ?film wdt:P577 ?date. } # publication dates
+      }
+    }
+    GROUP BY ?film ?modified
+""", selector='pattern')
+
+
+def stats_films_query(selector):
+    """
+    Generalised QUERY 8: per-film award count, first publication year and last modification for the films
+    matched by selector, usually a VALUES block of films_selector. Without labels, see stats_labels_query.
+    """
+    return query_stats_films.bind(selector=selector)
+
+
+query_stats_labels = PreparedQuery('STATS labels', """
+    SELECT ?film ?filmLabel
+    WHERE {
+      VALUES ?film {%(films)s}
+      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+    }
+""", films='entities')
+
+
+def stats_labels_query(entity_ids):
+    """
+    Labels of the films of a ranking, fetched only for the rows that are shown.
+    """
+    return query_stats_labels.bind(films=entity_ids)
+
+
+query_stats_amounts = PreparedQuery('STATS amounts', """
+    SELECT ?film ?unit (MAX(?box_amount) AS ?box) (MAX(?cost_amount) AS ?cost)
+    WHERE {
+      %(selector)s
+      { ?film p:P2142/psv:P2142 [wikibase:quantityAmount ?box_amount; wikibase:quantityUnit ?unit]. } # box office
+      UNION
+      { ?film p:P2130/psv:P2130 [wikibase:quantityAmount ?cost_amount; wikibase:quantityUnit ?unit]. } # cost
+    }
+    GROUP BY ?film ?unit
+""", selector='pattern')
+
+
+def stats_amounts_query(selector):
+    """
+    Generalised QUERY 6: highest box office takings and cost per film and currency for the films matched by selector.
+    """
+    return query_stats_amounts.bind(selector=selector)
+
+
+query_stats_modified = PreparedQuery('STATS modified', """
+    SELECT DISTINCT ?film ?modified
+    WHERE {
+      %(classes)s
+      ?film wdt:P31 ?class;
+            wdt:P136 %(genre)s;
+            schema:dateModified ?modified.
+    }
+""", classes='pattern', genre='entity')
+
+
+def stats_modified_query(genre_id):
+    """
+    Last modification of every film of a genre, used to refresh only the films that changed.
+    """
+    return query_stats_modified.bind(classes=film_class_values(), genre=genre_id)
+
+
+def films_selector(entity_ids):
+    return 'VALUES ?film {%s}' % sparql_entities(entity_ids)
+
+
+query_9 = PreparedQuery('QUERY 9', """
+    SELECT DISTINCT ?film ?filmLabel ?coords
+    WHERE {
+      %(classes)s # film and all its subclasses
+      ?film wdt:P31 ?class;
+            wdt:P136 %(genre)s; # films belonging to specific genre
+            wdt:P915 [wdt:P625 ?coords]. # get coordinates of location
+      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+    }
+""", classes='pattern', genre='entity')
+
+
+def filming_locations_query(genre_id):
+    """
+    QUERY 9: filming locations of all films of a genre with their coordinates.
+    """
+    return query_9.bind(classes=film_class_values(), genre=genre_id)
+
+
+query_10 = PreparedQuery('QUERY 10', """
+    SELECT ?cast_member ?cast_memberLabel ?coordinates ?film_list
+    WHERE {
+      {
+        # concatenate all films cast member was part
+        SELECT ?cast_member ?coordinates (GROUP_CONCAT(DISTINCT ?filmLabel; SEPARATOR = ", ") AS ?film_list)
+        WHERE {
+          %(classes)s # film and all its subclasses
+          ?film wdt:P31 ?class;
+                wdt:P136 %(genre)s;
+                wdt:P161 ?cast_member; # cast member
+                rdfs:label ?filmLabel. # get film label
+          FILTER((LANG(?filmLabel)) = "en") # only get English labels
+          ?cast_member wdt:P27 wd:Q39; # cast member needs to be Swiss
+                       wdt:P19 [wdt:P625 ?coordinates]. # get coordinates of place of birth
+        }
+        GROUP BY ?cast_member ?coordinates # group needed for concatenation
+      }
+      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+    }
+""", classes='pattern', genre='entity')
+
+
+def swiss_cast_query(genre_id):
+    """
+    QUERY 10: Swiss cast members of films of a genre with the coordinates of their birthplace and their films.
+    """
+    return query_10.bind(classes=film_class_values(), genre=genre_id)
+
+
+film_analytics_names = {1: 'QUERY 4', 2: 'QUERY 5', 3: 'QUERY 6', 4: 'QUERY 7'}
+
+
+query_4 = PreparedQuery('QUERY 4', """
+    SELECT ?film (AVG(?age_first_publ) AS ?avg) { # take ages at first publication and average them
+    # return these variables, take maximum age (as sometimes multiple publication dates are available)
+    SELECT ?film ?cast_member (MAX(?age) AS ?age_first_publ)
+    WHERE
+    { # set user film ID input as film variable
+      VALUES ?film {%(films)s} # no check for genre needed as it was done already in query 2/3
+      ?film wdt:P161 ?cast_member; # get cast members
+            wdt:P577 ?pub_date. # get publication date of film
+      ?cast_member wdt:P569 ?birth_date. # get birth date of cast member
+      BIND(YEAR(?pub_date) - YEAR(?birth_date) as ?age)
+      }
+    GROUP BY ?film ?cast_member
+    }
+    GROUP BY ?film # one average per film
+""", films='entities')
+
+
+query_5 = PreparedQuery('QUERY 5', """
+    SELECT ?film ?sex_gender_list (COUNT(?sex_gender_list) AS ?count) { # count how many of each label
+      # create list of concatenated labels, as e.g. someone can be non-binary as well as transgender
+      # so we take this as one label
+      SELECT ?film ?cast_member (GROUP_CONCAT(DISTINCT ?genderLabel; SEPARATOR = ", ") AS ?sex_gender_list)
+      WHERE {
+        VALUES ?film {%(films)s}
+        ?film wdt:P161 ?cast_member.
+        ?cast_member wdt:P21 [rdfs:label ?genderLabel]. # get sex/gender labels of cast members
+        FILTER((LANG(?genderLabel)) = "en") # only english sex/gender labels
+      }
+      GROUP BY ?film ?cast_member # group by needed for group concat
+    }
+    GROUP BY ?film ?sex_gender_list # group by needed for count
+""", films='entities')
+
+
+query_6 = PreparedQuery('QUERY 6', """
+    SELECT ?film (MAX(?box_office) AS ?box) ?cost ((?box - ?cost) AS ?difference) ?cost_unitLabel
+    WHERE {
+      VALUES ?film {%(films)s}
+      ?film wdt:P2142 ?box_office; # box office takings of film
+            p:P2142 [psv:P2142 ?box_node]; # get node for box office takings
+            wdt:P2130 ?cost; # cost of film
+            p:P2130 [psv:P2130 ?cost_node]. # get node of cost
+      ?cost_node wikibase:quantityUnit ?cost_unit. # get currency of cost
+      ?box_node wikibase:quantityUnit ?box_unit. # get currency of box office takings
+      FILTER (?cost_unit = ?box_unit) # only take those with same currency as otherwise not comparable
+      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+    }
+    GROUP BY ?film ?box ?cost ?difference ?cost_unitLabel
+""", films='entities')
+
+
+query_7 = PreparedQuery('QUERY 7', """
+    # tilde as a separator to avoid splitting at comma in film title within python
+    # create list including all films except for current selected one by director
+    SELECT ?film ?directorLabel (GROUP_CONCAT(DISTINCT ?other_filmLabel; SEPARATOR = " ~ ") AS ?film_list) (COUNT(DISTINCT ?other_filmLabel) AS ?count)
+    WHERE {
+      VALUES ?film {%(films)s}
+      %(classes)s # film and all its subclasses
+      ?film wdt:P57 ?director. # director variable
+      ?other_film wdt:P57 ?director; # other films need to have the same director
+                  wdt:P31 ?class;
+                  rdfs:label ?other_filmLabel. # get labels of other films
+      FILTER(?other_film != ?film) # sort out our current film selected by user
+      FILTER((LANG(?other_filmLabel)) = "en") # get english labels only
+      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+    }
+    GROUP BY ?film ?directorLabel # group by film and director for group concat
+""", films='entities', classes='pattern')
+
+
+def film_analytics_queries(*entity_ids) -> dict:
+    """
+    Builds the queries behind the per-film options [1]-[4], keyed by option number.
+    Several entity IDs can be given to analyse them in one query each, every row is bound to its ?film.
+    """
+    queries = {}
+
+    # QUERY 4: average age of all cast members at the first publication date
+    queries[1] = query_4.bind(films=entity_ids)
+
+    # QUERY 5: show sex/gender count of cast members
+    # also handles cases where more than one sex/gender property given by listing everything
+    queries[2] = query_5.bind(films=entity_ids)
+
+    # QUERY 6: show box office takings and cost and calculate their difference if
+    # they are in the same currency:
+    queries[3] = query_6.bind(films=entity_ids)
+
+    # QUERY 7: list director(s) of this film with all their other films
+    queries[4] = query_7.bind(films=entity_ids, classes=film_class_values())
+
+    return queries
+
+
+def chunk_entity_ids(entity_ids, size=batch_size, max_chars=batch_max_chars):
+    """
+    Splits entity IDs into chunks for VALUES blocks, limited by count and by the length of the VALUES list.
+    """
+    chunk = []
+    chars = 0
+    for entity_id in entity_ids:
+        if chunk and (len(chunk) >= size or chars + len(entity_id) + 4 > max_chars):
+            yield chunk
+            chunk = []
+            chars = 0
+        chunk.append(entity_id)
+        chars += len(entity_id) + 4  # "wd:" prefix and separating space
+    if chunk:
+        yield chunk
+
+
+def iter_film_analytics(entity_ids, options=(1, 2, 3, 4), executor=None, timeout=None, size=batch_size,
+                        window=analytics_window):
+    """
+    Runs the per-film queries for many films with one query per option and chunk of IDs instead of one per film.
+    Yields (entity ID, {option: [bindings]}) chunk by chunk in the order of entity_ids, films without data get
+    empty lists. At most window chunks are queried ahead, so only their bindings are held at a time.
+    """
+    executor = executor or get_executor()
+    chunks = chunk_entity_ids(list(dict.fromkeys(entity_ids)), size)  # drop duplicates, keep order
+
+    def start(chunk):
+        queries = film_analytics_queries(*chunk)
+        return chunk, {option: executor.submit(queries[option], 'film', timeout, film_analytics_names[option])
+                       for option in options}
+
+    pending = [start(chunk) for chunk in itertools.islice(chunks, window)]
+    try:
+        while pending:
+            chunk, submitted = pending.pop(0)
+            analytics = {entity_id: {option: [] for option in options} for entity_id in chunk}
+            for option, future in submitted.items():
+                for binding in future.result()['results']['bindings']:
+                    entity_id = binding['film']['value'][len(entity_prefix):]
+                    if entity_id in analytics:
+                        analytics[entity_id][option].append(binding)
+            pending.extend(start(chunk) for chunk in itertools.islice(chunks, 1))  # keep the next one running
+            yield from analytics.items()
+    finally:
+        for chunk, submitted in pending:  # failed or stopped early, do not leave the chunks ahead running
+            for future in submitted.values():
+                future.cancel()
+
+
+def prefetch_film_analytics(entity_id, executor=None, timeout=None) -> dict:
+    """
+    Starts all per-film queries at once so each option can be answered without waiting for the endpoint.
+    Returns futures keyed by option number.
+    """
+    executor = executor or get_executor()
+    return executor.submit_all(film_analytics_queries(entity_id), 'film', timeout, film_analytics_names)
+
+
+class GenreStats:
+    """
+    Materialised per-film award counts, publication years and box office/cost per currency for whole genres,
+    kept in sqlite next to the result cache. A genre is built from the list of its films, whose stats are fetched
+    in chunks of stats_batch_size films, later refreshes only re-query films whose modification date changed,
+    and rankings with any n, order and filter are answered locally. Labels are fetched for the rows shown.
+    """
+    box_office_orders = {'difference': 'a.box - a.cost', 'box': 'a.box', 'cost': 'a.cost',
+                         'ratio': 'CAST(a.box AS REAL) / a.cost'}
+    box_office_labels = {'difference': 'difference', 'box': 'box office takings', 'cost': 'cost',
+                         'ratio': 'box office takings / cost'}
+
+    def __init__(self, path: str = None):
+        self.lock = threading.Lock()
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            except (OSError, sqlite3.Error):
+                path = None
+        if not path:
+            self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS films (film INTEGER PRIMARY KEY, label TEXT, '
+                            'awards INTEGER, year INTEGER, modified TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS genre_films (genre TEXT, film INTEGER, '
+                            'PRIMARY KEY (genre, film))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS amounts (film INTEGER, currency TEXT, box INTEGER, '
+                            'cost INTEGER, PRIMARY KEY (film, currency))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS genres (genre TEXT PRIMARY KEY, refreshed REAL)')
+
+    def refreshed(self, genre_id):
+        with self.lock:
+            row = self.db.execute('SELECT refreshed FROM genres WHERE genre = ?', (genre_id,)).fetchone()
+        return row[0] if row else None
+
+    def _store(self, genre_id, film_bindings, amount_bindings, film_ids=None):
+        with self.lock, self.db:
+            if film_ids is not None:  # replace the amounts of refreshed films completely
+                self.db.executemany('DELETE FROM amounts WHERE film = ?', ((film,) for film in film_ids))
+            for binding in film_bindings:
+                film = int(binding['film']['value'][len(entity_prefix) + 1:])
+                self.db.execute('INSERT OR REPLACE INTO films VALUES (?, ?, ?, ?, ?)',
+                                (film, None,  # labels are fetched for the rows shown, see _labelled
+                                 to_int(binding['awards']['value']),
+                                 to_int(binding['year']['value']) if 'year' in binding else None,
+                                 binding['modified']['value']))
+                self.db.execute('INSERT OR IGNORE INTO genre_films VALUES (?, ?)', (genre_id, film))
+            for binding in amount_bindings:
+                self.db.execute('INSERT OR REPLACE INTO amounts VALUES (?, ?, ?, ?)',
+                                (int(binding['film']['value'][len(entity_prefix) + 1:]),
+                                 binding['unit']['value'][len(entity_prefix):],
+                                 to_int(binding['box']['value']) if 'box' in binding else None,
+                                 to_int(binding['cost']['value']) if 'cost' in binding else None))
+
+    def refresh(self, genre_id) -> int:
+        """
+        Lists the films of a genre with their modification date and queries only films that are new or were
+        modified since they were stored, in chunks of stats_batch_size films, and drops films that left the genre.
+        Builds a genre the first time, a build that failed part way continues with the chunks still missing.
+        Returns the number of films fetched again.
+        """
+        current = {}
+        for binding in get_results_request(stats_modified_query(genre_id), use_cache=False,
+                                           name='STATS modified')['results']['bindings']:
+            current[int(binding['film']['value'][len(entity_prefix) + 1:])] = binding['modified']['value']
+        with self.lock:
+            stored = dict(self.db.execute('SELECT f.film, f.modified FROM films f JOIN genre_films g '
+                                          'ON f.film = g.film WHERE g.genre = ?', (genre_id,)).fetchall())
+        changed = [film for film, modified in current.items() if stored.get(film) != modified]
+        removed = [film for film in stored if film not in current]
+
+        pending = []
+        for chunk in chunk_entity_ids([f'Q{film}' for film in changed], stats_batch_size):
+            selector = films_selector(chunk)
+            # bypass the cache, a cached answer for the same films would predate the change
+            pending.append((chunk, get_executor().call(get_results_request, stats_films_query(selector), 'film',
+                                                       False, None, 'STATS films'),
+                            get_executor().call(get_results_request, stats_amounts_query(selector), 'film',
+                                                False, None, 'STATS amounts')))
+        try:
+            for chunk, films, amounts in pending:  # stored chunk by chunk, kept if a later chunk fails
+                self._store(genre_id, films.result()['results']['bindings'],
+                            amounts.result()['results']['bindings'], [int(entity_id[1:]) for entity_id in chunk])
+        except BaseException:
+            for chunk, films, amounts in pending:  # do not leave the remaining chunks running for nothing
+                films.cancel()
+                amounts.cancel()
+            raise
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM genre_films WHERE genre = ? AND film = ?',
+                                ((genre_id, film) for film in removed))
+            self.db.execute('INSERT OR REPLACE INTO genres VALUES (?, ?)', (genre_id, time.time()))
+        return len(changed)
+
+    def ensure(self, genre_id, max_age=stats_refresh_interval):
+        """
+        Builds the stats of a genre if missing and refreshes changed films if they are older than max_age.
+        """
+        refreshed = self.refreshed(genre_id)
+        if refreshed is None or time.time() - refreshed > max_age:
+            self.refresh(genre_id)
+
+    def _select(self, sql, args):
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return rows
+
+    def _labelled(self, rows):
+        """
+        Fills in the labels of ranking rows (film, label, ...) whose films are stored without one yet and
+        keeps them for the next ranking. Refreshed films lose their label and get it again when shown.
+        """
+        missing = [f'Q{row[0]}' for row in rows if row[1] is None]
+        labels = {}
+        try:
+            for chunk in chunk_entity_ids(missing, stats_batch_size):
+                for binding in get_results_request(stats_labels_query(chunk), 'film', False,
+                                                   name='STATS labels')['results']['bindings']:
+                    labels[int(binding['film']['value'][len(entity_prefix) + 1:])] = binding['filmLabel']['value']
+        except requests.RequestException:
+            pass  # shown without labels this time, they are asked for again with the next ranking
+        if labels:
+            with self.lock, self.db:
+                self.db.executemany('UPDATE films SET label = ? WHERE film = ?',
+                                    ((label, film) for film, label in labels.items()))
+        return [(row[0], labels.get(row[0], '') if row[1] is None else row[1], *row[2:]) for row in rows]
+
+    @staticmethod
+    def _genres(genre_ids):
+        genre_ids = [genre_ids] if isinstance(genre_ids, str) else list(genre_ids)
+        return genre_ids, ', '.join('?' * len(genre_ids))
+
+    def top_awards(self, genre_ids, n=10, year=None, ascending=False) -> dict:
+        """
+        Films of one genre or several genres together ranked by number of awards, in the shape of a QUERY 8
+        response. Films of several genres are counted once, genres lists the genres they were found in.
+        """
+        genre_ids, marks = self._genres(genre_ids)
+        rows = self._select('SELECT f.film, f.label, f.awards, GROUP_CONCAT(g.genre, \' \') FROM films f '
+                            f'JOIN genre_films g ON f.film = g.film WHERE g.genre IN ({marks}) AND f.awards > 0 '
+                            'AND (? IS NULL OR f.year = ?) GROUP BY f.film '
+                            f'ORDER BY f.awards {"ASC" if ascending else "DESC"}, f.film LIMIT ?',
+                            (*genre_ids, year, year, n))
+        rows = self._labelled(rows)
+        return {'results': {'bindings': [
+            {'film': {'type': 'uri', 'value': f'{entity_prefix}Q{film}'}, 'filmLabel': {'value': label},
+             'count': {'value': str(awards)}, 'genres': {'value': genres}} for film, label, awards, genres in rows]}}
+
+    def top_box_office(self, genre_ids, n=10, currency='USD', year=None, order='difference',
+                       ascending=False) -> dict:
+        """
+        Films of one genre or several genres together with box office takings and cost in the same currency,
+        ranked by their difference (or by box, cost or ratio), in the shape of the altered QUERY 6 response.
+        """
+        genre_ids, marks = self._genres(genre_ids)
+        unit, unit_label = currencies.get(currency, (currency, currency))
+        rows = self._select('SELECT f.film, f.label, a.box, a.cost, GROUP_CONCAT(g.genre, \' \') FROM films f '
+                            'JOIN genre_films g ON f.film = g.film JOIN amounts a ON f.film = a.film '
+                            f'WHERE g.genre IN ({marks}) AND a.currency = ? '
+                            'AND a.box IS NOT NULL AND a.cost IS NOT NULL AND (? IS NULL OR f.year = ?) '
+                            f'GROUP BY f.film ORDER BY {self.box_office_orders[order]} '
+                            f'{"ASC" if ascending else "DESC"}, f.film LIMIT ?', (*genre_ids, unit, year, year, n))
+        rows = self._labelled(rows)
+        return {'results': {'bindings': [
+            {'film': {'type': 'uri', 'value': f'{entity_prefix}Q{film}'}, 'filmLabel': {'value': label},
+             'box': {'value': str(box)}, 'cost': {'value': str(cost)}, 'difference': {'value': str(box - cost)},
+             'cost_unitLabel': {'value': unit_label}, 'genres': {'value': genres}}
+            for film, label, box, cost, genres in rows]}}
+
+
+def get_stats() -> GenreStats:
+    """
+    Returns the shared genre stats store, opened on first use next to the result cache.
+    """
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            _stats = GenreStats(os.path.join(cache_dir, 'stats.sqlite3') if cache_dir else None)
+    return _stats
+
+
+wkt_point = re.compile(r'\s*(?:<([^>]*)>\s*)?Point\(\s*(\S+)\s+(\S+)\s*\)\s*$', re.IGNORECASE)
+
+
+def parse_wkt_point(value):
+    """
+    Returns (longitude, latitude) of a WKT point literal such as "Point(8.54 47.37)", None for anything else
+    including points on other globes than Earth.
+    """
+    match = wkt_point.match(value)
+    if match is None or match.group(1) not in (None, f'{entity_prefix}Q2'):
+        return None
+    try:
+        return float(match.group(2)), float(match.group(3))
+    except ValueError:
+        return None
+
+
+def map_features(bindings, coords, label, entity, detail=None) -> dict:
+    """
+    Converts results with a WKT coordinate column into a GeoJSON feature collection with one feature per
+    distinct location, listing the label, entity ID and optional detail of every row found there.
+    """
+    locations = {}
+    for binding in bindings:
+        point = parse_wkt_point(binding.get(coords, {}).get('value', ''))
+        if point is None:
+            continue
+        item = [binding.get(label, {}).get('value', ''), binding[entity]['value'][len(entity_prefix):]]
+        if detail is not None:
+            item.append(binding.get(detail, {}).get('value', ''))
+        locations.setdefault(point, []).append(item)
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': list(point)},
+                          'properties': {'count': len(items), 'items': items}}
+                         for point, items in locations.items()]}
+
+
+# page drawing the features with Leaflet, nearby markers are merged into clusters on every zoom level
+map_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>
+html, body, #map { height: 100%%; margin: 0; }
+.cluster { background: rgba(200, 40, 40, 0.75); border-radius: 50%%; color: white; font: bold 12px sans-serif;
+           display: flex; align-items: center; justify-content: center; }
+</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+const data = %(data)s;
+const radius = %(radius)d;
+const map = L.map('map', {preferCanvas: true, worldCopyJump: true}).setView([20, 0], 2);
+L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png',
+            {maxZoom: 18, attribution: '&copy; OpenStreetMap contributors'}).addTo(map);
+const layer = L.layerGroup().addTo(map);
+
+function escape(text) {
+  return String(text).replace(/[&<>"]/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}[c]));
+}
+
+function popup(features) {
+  const items = features.flatMap(feature => feature.properties.items);
+  const rows = items.slice(0, 200).map(([label, id, detail]) =>
+    `<a href="https://www.wikidata.org/wiki/${id}" target="_blank">${escape(label || id)}</a>` +
+    (detail ? `<br><small>${escape(detail)}</small>` : ''));
+  if (items.length > rows.length) rows.push(`and ${items.length - rows.length} more`);
+  return `<div style="max-height: 300px; overflow: auto">${rows.join('<br>')}</div>`;
+}
+
+function draw() {
+  layer.clearLayers();
+  const zoom = map.getZoom();
+  const cells = new Map();
+  for (const feature of data.features) {
+    const [lon, lat] = feature.geometry.coordinates;
+    const point = map.project([lat, lon], zoom);
+    const key = Math.floor(point.x / radius) + ',' + Math.floor(point.y / radius);
+    let cell = cells.get(key);
+    if (!cell) cells.set(key, cell = {lat: 0, lon: 0, count: 0, features: []});
+    cell.lat += lat * feature.properties.count;
+    cell.lon += lon * feature.properties.count;
+    cell.count += feature.properties.count;
+    cell.features.push(feature);
+  }
+  for (const cell of cells.values()) {
+    const center = [cell.lat / cell.count, cell.lon / cell.count];
+    if (cell.features.length === 1 || zoom >= map.getMaxZoom()) {
+      L.circleMarker(center, {radius: 6, color: '#c82828'}).bindPopup(() => popup(cell.features)).addTo(layer);
+    } else {
+      const size = 24 + 6 * Math.log10(cell.count);
+      L.marker(center, {icon: L.divIcon({className: 'cluster', html: String(cell.count), iconSize: [size, size]})})
+        .on('click', () => map.setView(center, Math.min(zoom + 2, map.getMaxZoom()))).addTo(layer);
+    }
+  }
+}
+
+if (data.features.length) {
+  map.fitBounds(data.features.map(feature => [feature.geometry.coordinates[1], feature.geometry.coordinates[0]]));
+}
+map.on('zoomend', draw);
+draw();
+</script>
+</body>
+</html>
+"""
+
+
+def write_map(features: dict, title: str, name: str) -> str:
+    """
+    Writes the features as name.geojson and as a self-contained map page name.html into the maps folder of
+    the cache (or the temporary folder) and returns the path of the page.
+    """
+    folder = os.path.join(cache_dir, 'maps') if cache_dir else os.path.join(tempfile.gettempdir(), 'wikidata_films')
+    os.makedirs(folder, exist_ok=True)
+    data = json.dumps(features, ensure_ascii=False, separators=(',', ':'))
+    with open(os.path.join(folder, f'{name}.geojson'), 'w', encoding='utf-8') as out:
+        out.write(data)
+    path = os.path.join(folder, f'{name}.html')
+    with open(path, 'w', encoding='utf-8') as out:
+        out.write(map_template % {'title': html.escape(title), 'radius': map_cluster_radius,
+                                  'data': data.replace('</', '<\\/')})  # keep labels from closing the script
+    return path
+
+
+def fan_out(function, genre_ids, workers=max_parallel_queries) -> dict:
+    """
+    Calls function(genre_id) for every genre, up to workers genres at a time, and returns {genre_id: result}.
+    All requests still pass the shared rate limiter, more workers only overlap the waiting for responses.
+    """
+    if workers <= 1 or len(genre_ids) <= 1:
+        return {genre_id: function(genre_id) for genre_id in genre_ids}
+    with futures.ThreadPoolExecutor(min(workers, len(genre_ids)), thread_name_prefix='genre') as pool:
+        return dict(zip(genre_ids, pool.map(function, genre_ids)))
+
+
+def merge_bindings(results_by_genre: dict, key=('film',), lists=()) -> dict:
+    """
+    Merges the results of one query for several genres, keeping one binding per distinct key with a genres
+    value naming every genre it was found in. Variables in lists hold ", " separated lists, which are joined.
+    """
+    merged = {}
+    genres = defaultdict(list)
+    variables = {'genres': None}
+    for genre_id, results in results_by_genre.items():
+        variables.update(dict.fromkeys(results.get('head', {}).get('vars', ())))
+        for binding in results['results']['bindings']:
+            identity = tuple(binding.get(name, {}).get('value') for name in key)
+            if identity not in merged:
+                merged[identity] = dict(binding)
+            else:
+                for name in lists:
+                    if name in binding:
+                        items = merged[identity].get(name, {}).get('value', '').split(', ')
+                        items += binding[name]['value'].split(', ')
+                        merged[identity][name] = dict(binding[name],
+                                                      value=', '.join(dict.fromkeys(filter(None, items))))
+            if genre_id not in genres[identity]:
+                genres[identity].append(genre_id)
+    for identity, binding in merged.items():
+        binding['genres'] = {'type': 'literal', 'value': ' '.join(genres[identity])}
+    return {'head': {'vars': [name for name in variables if name != 'genres'] + ['genres']},
+            'results': {'bindings': list(merged.values())}}
+
+
+# genre-level queries that can run over several genres at once: query builder, name, key of a distinct row
+# and list variables to join when a row is found in several genres
+cross_genre_queries = {'films': (genre_films_query, 'QUERY 1', ('film',), ()),
+                       'locations': (filming_locations_query, 'QUERY 9', ('film', 'coords'), ()),
+                       'swiss_cast': (swiss_cast_query, 'QUERY 10', ('cast_member', 'coordinates'), ('film_list',))}
+
+
+def cross_genre_results(genre_ids, report='films', top=10, year=None, currency='USD',
+                        workers=max_parallel_queries, order='difference', ascending=False) -> dict:
+    """
+    Runs a genre-level query for any set of genres concurrently and returns one merged result without
+    duplicates, since a film can have several genres: the film listing, the awards or box office top n
+    over all genres together, or the filming locations and Swiss cast birthplaces for the maps.
+    """
+    genre_ids = list(dict.fromkeys(genre_ids))
+    if report in ('awards', 'box_office'):
+        stats = get_stats()
+        fan_out(stats.ensure, genre_ids, workers)
+        if report == 'awards':
+            return stats.top_awards(genre_ids, top, year, ascending)
+        return stats.top_box_office(genre_ids, top, currency, year, order, ascending)
+    if report not in cross_genre_queries:
+        raise ValueError(f'unknown report "{report}", expected one of awards, box_office, '
+                         f'{", ".join(cross_genre_queries)}')
+    build, name, key, lists = cross_genre_queries[report]
+    results = fan_out(lambda genre_id: get_results_request(build(genre_id), 'genre', name=name), genre_ids, workers)
+    return merge_bindings(results, key, lists)
+
+
+report_kinds = ('films', 'awards', 'box_office', 'analytics', 'locations', 'swiss_cast')
+export_formats = ('csv', 'jsonl', 'parquet')
+
+
+def resolve_genre(genre: str) -> str:
+    """
+    Turns a menu number (1-7), a genre name such as "action" or a Wikidata ID into the genre's entity ID.
+    """
+    genre = genre.strip()
+    if re.fullmatch(r'Q\d+', genre):
+        return genre
+    if genre.isdigit() and int(genre) in film_id_genre_dict:
+        return film_id_genre_dict[int(genre)][1]
+    for name, genre_id in film_id_genre_dict.values():
+        if genre.lower() in (name, name[:-len(' film')]):
+            return genre_id
+    raise ValueError(f'unknown genre "{genre}"')
+
+
+def binding_row(binding: dict) -> dict:
+    """
+    Flattens a binding to {variable: value}, entity URIs are shortened to their ID.
+    """
+    return {name: term['value'][len(entity_prefix):] if term['value'].startswith(entity_prefix) else term['value']
+            for name, term in binding.items()}
+
+
+def film_analytics_row(entity_id, label, analytics) -> dict:
+    """
+    Summarises the results of the four per-film queries in one flat row.
+    """
+    age = analytics.get(1) or [{}]
+    box_office = analytics.get(3) or [{}]
+    directors = analytics.get(4, [])
+    return {'film': entity_id, 'filmLabel': label,
+            'avg_age': age[0].get('avg', {}).get('value', ''),
+            'sex_gender_count': '; '.join(f"{item['sex_gender_list']['value']}: {item['count']['value']}"
+                                          for item in analytics.get(2, [])),
+            'box': box_office[0].get('box', {}).get('value', ''),
+            'cost': box_office[0].get('cost', {}).get('value', ''),
+            'difference': box_office[0].get('difference', {}).get('value', ''),
+            'currency': box_office[0].get('cost_unitLabel', {}).get('value', ''),
+            'directors': '; '.join(item['directorLabel']['value'] for item in directors),
+            'director_films': sum(int(item['count']['value']) for item in directors)}
+
+
+def genre_report(genre_id, report='films', top=10, year=None, currency='USD', order='difference', ascending=False):
+    """
+    Yields the rows of one report for a genre: the full film listing (QUERY 1), the top n films by awards
+    or by box office difference (or another of GenreStats.box_office_orders) in a currency, from GenreStats,
+    optionally for one publication year and lowest first,
+    the per-film analytics (QUERY 4-7) of every film, or the filming locations (QUERY 9) and Swiss cast
+    birthplaces (QUERY 10).
+    """
+    if report == 'films':
+        # not cached: caching would hold every binding of the genre until the stream ends
+        bindings = iter_results_request(genre_films_query(genre_id), kind='genre', use_cache=False, name='QUERY 1')
+    elif report in ('awards', 'box_office'):
+        stats = get_stats()
+        stats.ensure(genre_id)
+        if report == 'awards':
+            bindings = stats.top_awards(genre_id, top, year, ascending)['results']['bindings']
+        else:
+            bindings = stats.top_box_office(genre_id, top, currency, year, order, ascending)['results']['bindings']
+    elif report in ('locations', 'swiss_cast'):
+        build, name = cross_genre_queries[report][:2]
+        bindings = get_results_request(build(genre_id), 'genre', name=name)['results']['bindings']
+    elif report == 'analytics':
+        films = FilmTable.from_bindings(iter_results_request(genre_films_query(genre_id), kind='genre',
+                                                             use_cache=False, name='QUERY 1'))
+        labels = dict(films.rows())
+        for entity_id, analytics in iter_film_analytics(labels):
+            yield dict(genre=genre_id, **film_analytics_row(entity_id, labels[entity_id], analytics))
+        return
+    else:
+        raise ValueError(f'unknown report "{report}", expected one of {", ".join(report_kinds)}')
+    for binding in bindings:
+        yield dict(genre=genre_id, **binding_row(binding))
+
+
+def genre_reports(genre_ids, report='films', top=10, workers=max_parallel_queries, year=None, currency='USD',
+                  order='difference', ascending=False):
+    """
+    Runs a report for several genres, up to workers genres at a time with fan_out, and yields their rows in
+    genre order. Rows are streamed with a single worker or genre, otherwise each genre's rows are collected.
+    """
+    if workers <= 1 or len(genre_ids) <= 1:
+        for genre_id in genre_ids:
+            yield from genre_report(genre_id, report, top, year, currency, order, ascending)
+        return
+    rows = fan_out(lambda genre_id: list(genre_report(genre_id, report, top, year, currency, order, ascending)),
+                   genre_ids, workers)
+    yield from itertools.chain.from_iterable(rows.values())
+
+
+def write_rows(rows, out, fmt='csv', batch_rows=10000) -> int:
+    """
+    Writes report rows to an open text file (csv, jsonl) or a path (parquet) as they come in.
+    Returns the number of rows written.
+    """
+    count = 0
+    if fmt == 'jsonl':
+        for count, row in enumerate(rows, 1):
+            out.write(json.dumps(row, ensure_ascii=False) + '\n')
+    elif fmt == 'csv':
+        writer = None
+        for count, row in enumerate(rows, 1):
+            if writer is None:
+                writer = csv.DictWriter(out, fieldnames=list(row), restval='', extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(row)
+    elif fmt == 'parquet':
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('parquet export needs pyarrow, install it with "pip install pyarrow"') from None
+        writer = None
+        try:
+            for batch in iter(lambda: list(itertools.islice(rows, batch_rows)), []):
+                # all columns as strings so batches with missing values share one schema
+                table = pyarrow.Table.from_pylist([{key: str(value) for key, value in row.items()} for row in batch])
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(out, table.schema)
+                writer.write_table(table.cast(writer.schema))
+                count += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        raise ValueError(f'unknown format "{fmt}", expected one of {", ".join(export_formats)}')
+    return count
+
+
 # chose to implement limit here to avoid constant new queries for limit and offset
 def print_request(results, start=0, limit=5):
+    # results is either a parsed response, a FilmTable, GenrePages or a list of bindings
+    bindings = results['results']['bindings'] if isinstance(results, dict) else results
+    page = bindings[start:limit]
+    if not isinstance(page, FilmTable):
+        page = FilmTable.from_bindings(page)
     print(f'\033[1m{"Entity ID":<15s} {"Label":<10s}\033[0m')  # ANSI escape sequence for bold header
-    counter = start
-    while counter < limit:
-        for item in results['results']['bindings'][start:limit]:
-            entity_id = item['film']['value'][31:]
-            item_label = item['filmLabel']['value']
-            print(f'{entity_id:<15s} {item_label:<10s}')
-            counter += 1
+    for entity_id, item_label in page.rows():
+        print(f'{entity_id:<15s} {item_label:<10s}')
+
+
+def print_directors(bindings):
+    """
+    Prints directors with their other films, four films per line.
+    """
+    print(f'\n\033[1m{"Director":<20s} {"Amount":<15s} {"Films":<15s}\033[0m')
+    for item in bindings:
+        director = item['directorLabel']['value']
+        count = item['count']['value']
+        films = item['film_list']['value']
+        # split for cleaner formatting output
+        split_films = [film for film in films.split(' ~ ')]
+        start = 0
+        stop = 4
+        combined_list = []
+        for i in range(int(len(split_films)/4)+1):  # prevent cutting off if float gets rounded down
+            combined_list.append(', '.join(split_films[start:stop]))
+            start += 4
+            stop += 4
+
+        print(f'\n{director:<20s} {count:<15s} {combined_list[0]:<15s}')
+
+        for films in combined_list[1:]:
+            print(f'{"":<20s} {"":<15s} {films:<15s}')
+
+
+def input_top_filters(orders: dict = None):
+    """
+    Asks how many films a ranking should show, optionally for a publication year, what to rank by if orders
+    maps more than one order to its label, and whether the highest or the lowest come first.
+    Returns top, year, order (None without orders) and ascending.
+    """
+    top = input_checker(input('\nHow many films should be shown? Enter an integer between 1 and 100:\n'
+                              '>> '), 1, 100)
+    year = input('\nEnter a year to only show films first published in it, or leave empty for all years:\n'
+                 '>> ').strip()
+    while year and not year.isdigit():
+        year = input(f'"{year}" is not a year. Please try again, or leave empty for all years:\n'
+                     f'>> ').strip()
+    order = next(iter(orders), None) if orders else None
+    if orders and len(orders) > 1:
+        order = list(orders)[input_checker(input(
+            f'\nRank the films by:\n'
+            f'{" ".join(f"[{number}] {label}" for number, label in enumerate(orders.values(), 1))}\n'
+            f'>> '), 1, len(orders)) - 1]
+    ascending = 2 == input_checker(input('\nShow the highest or the lowest first?\n'
+                                         '[1] highest [2] lowest\n'
+                                         '>> '), 1, 2)
+    return top, int(year) if year else None, order, ascending
+
+
+def load_stats(genre_id, genre_str):
+    """
+    Returns the genre stats with the genre built or refreshed for a ranking. If the query service fails,
+    stats refreshed earlier are still used, without them the user is told and None is returned.
+    """
+    stats = get_stats()
+    try:
+        stats.ensure(genre_id)
+    except requests.RequestException as error:
+        if stats.refreshed(genre_id) is None:
+            print(f'\nThe {genre_str}s could not be ranked, the query service did not answer ({error}). '
+                  f'Films fetched so far are kept, please try again later.')
+            return None
+        print(f'\nShowing the {genre_str}s as of the last refresh, the query service did not answer ({error}).')
+    return stats
+
+
+def warm_up():
+    """
+    Imports the HTTP stack and opens the session and the result cache, run in the background while the
+    first prompt waits for input.
+    """
+    get_session()
+    get_cache()
 
 
 def main():
+    threading.Thread(target=warm_up, daemon=True).start()
     restart = True  # last input of program asks whether user wants to restart, while true program will continue
 
     while restart:
@@ -136,28 +2266,9 @@ def main():
                                 f'romance\n '
                                 f'>> '))
 
-        film_id_genre_dict = {1: ('action film', 'Q188473'), 2: ('adventure film', 'Q319221'), 3: ('drama film', 'Q130232'),
-                              4: ('comedy film', 'Q157443'), 5: ('documentary film', 'Q93204'),
-                              6: ('thriller film', 'Q2484376'),
-                              7: ('romance film', 'Q1054574')}
-
         genre_str = film_id_genre_dict[i][0]
         film_genre_id = film_id_genre_dict[i][1]
 
-        # look for all instances/subclasses of film and show the ones that have the selected genre as property
-        # this string formatting method instead f-string as brackets are present;
-        # no LIMIT on purpose to get everything without additional requests if user requests;
-
-        # QUERY 1: film that belongs to certain genre
-        query = """
-        SELECT ?film ?filmLabel
-        WHERE {
-        ?film wdt:P31/wdt:P279* wd:Q11424; # variable is instance/subclass of film
-              wdt:P136 wd:%s. # variable film has certain genre
-        SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-        }
-        """ % film_genre_id
-
         print(f'\nHere are 10 {genre_str}s as an overview:')
 
         done = False
@@ -174,11 +2285,14 @@ def main():
 
         t = threading.Thread(target=loading)
         t.start()
-        results = get_results_request(query)  # first query might take a while, also depending on connection
+        # QUERY 1: film that belongs to certain genre, fetched page by page as the user asks for more
+        results = GenrePages(film_genre_id)
+        results.page(0)
         sys.stdout.write('\r' + '')
         done = True
 
         print_request(results, 0, 10)
+        index = LabelIndex(results.films)  # films seen so far, label search falls back to QUERY 3 otherwise
 
         i_2 = input_checker(input(f'\nEnter an integer to select an option:\n'
                                   f'[1] query with specific entity [2] query on all {genre_str}s\n'
@@ -196,7 +2310,7 @@ def main():
                 print(f'\nMore {genre_str}s:')
                 offset += 10
 
-                # reuse results of QUERY 1 with added offset in python
+                # next rows of QUERY 1, usually already prefetched
                 print_request(results, offset, offset + 10)
 
                 i_3 = input_checker(input(f'\nSelection of the {genre_str}:\n'
@@ -216,7 +2330,10 @@ def main():
                 while i_4 == 2:
 
                     # QUERY 3: find labels that contain user given input, return first
-                    i_4, entity_id, item_label = find_by_string(genre_str, film_genre_id)
+                    i_4, entity_id, item_label = find_by_string(genre_str, film_genre_id, index)
+
+            # run all four film queries in parallel right away, options below only wait for their result
+            analytics = prefetch_film_analytics(entity_id)
 
             restart_single = True
             while restart_single:
@@ -229,27 +2346,10 @@ def main():
 
                 if i_5 == 1:
                     # QUERY 4: average age of all cast members at the first publication date
-                    query = """
-                    SELECT (AVG(?age_first_publ) AS ?avg) { # take ages at first publication and average them
-                    # return these variables, take maximum age (as sometimes multiple publication dates are available)
-                    SELECT ?cast_member ?cast_memberLabel (MAX(?age) AS ?age_first_publ) 
-                    WHERE 
-                    { # set user film ID input as film variable
-                      VALUES ?film {wd:%s} # no check for genre needed as it was done already in query 2/3
-                      ?film wdt:P161 ?cast_member; # get cast members
-                            wdt:P577 ?pub_date. # get publication date of film
-                      ?cast_member wdt:P569 ?birth_date. # get birth date of cast member
-                      BIND(YEAR(?pub_date) - YEAR(?birth_date) as ?age)
-                      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-        
-                      }
-                    GROUP BY ?cast_member ?cast_memberLabel ?total ?avg
-                    }
-                    """ % entity_id
-
-                    results = get_results_request(query)
-
-                    avg_age = results["results"]["bindings"][0]["avg"]["value"][:5]
+                    results = analytics[1].result()
+
+                    bindings = results["results"]["bindings"]
+                    avg_age = bindings[0]["avg"]["value"][:5] if bindings else "0"
                     if avg_age == "0":
                         print(f'\nThere is no data about the cast members of "{item_label}". '
                               f'Cannot calculate average age.')
@@ -259,25 +2359,7 @@ def main():
 
                 if i_5 == 2:
                     # QUERY 5: show sex/gender count of cast members
-                    # also handles cases where more than one sex/gender property given by listing everything
-                    query = """
-                    SELECT ?sex_gender_list (COUNT(?sex_gender_list) AS ?count) { # count how many of each label
-                      # create list of concatenated labels, as e.g. someone can be non-binary as well as transgender
-                      # so we take this as one label
-                      SELECT ?cast_memberLabel (GROUP_CONCAT(DISTINCT ?genderLabel; SEPARATOR = ", ") AS ?sex_gender_list) 
-                      WHERE {
-                        VALUES ?film {wd:%s}
-                        ?film wdt:P161 ?cast_member.
-                        ?cast_member wdt:P21 [rdfs:label ?genderLabel]. # get sex/gender labels of cast members
-                        FILTER((LANG(?genderLabel)) = "en") # only english sex/gender labels
-                        SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". } # get labels for rest
-                      }
-                      GROUP BY ?cast_memberLabel ?count # group by needed for group concat
-                    }
-                    GROUP BY ?sex_gender_list ?count # group by needed for count
-                    """ % entity_id
-
-                    results = get_results_request(query)
+                    results = analytics[2].result()
 
                     print(f'\n\033[1m{"Count":<15s} {"Label":<10s}\033[0m')
                     for item in results["results"]["bindings"]:
@@ -286,25 +2368,8 @@ def main():
                         print(f'{count:<15s} {label:<10s}')
 
                 if i_5 == 3:
-                    # QUERY 6: show box office takings and cost and calculate their difference if
-                    # they are in the same currency:
-                    query = """
-                    SELECT (MAX(?box_office) AS ?box) ?cost ((?box - ?cost) AS ?difference) ?cost_unitLabel
-                    WHERE {
-                      VALUES ?film{wd:%s}
-                      ?film wdt:P2142 ?box_office; # box office takings of film
-                            p:P2142 [psv:P2142 ?box_node]; # get node for box office takings
-                            wdt:P2130 ?cost; # cost of film
-                            p:P2130 [psv:P2130 ?cost_node]. # get node of cost
-                      ?cost_node wikibase:quantityUnit ?cost_unit. # get currency of cost
-                      ?box_node wikibase:quantityUnit ?box_unit. # get currency of box office takings
-                      FILTER (?cost_unit = ?box_unit) # only take those with same currency as otherwise not comparable
-                      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-                    }
-                    GROUP BY ?box ?cost ?difference ?cost_unitLabel 
-                    """ % entity_id
-
-                    results = get_results_request(query)
+                    # QUERY 6: box office takings, cost and their difference
+                    results = analytics[3].result()
 
                     if len(results['results']['bindings']) == 0:
                         print(f'\nUnfortunately, "{item_label}" does not have information about both box office \n'
@@ -319,49 +2384,14 @@ def main():
                         print(f'{diff:<15,d} {box:<15,d} {cost:<15,d} {cur:<15s}')
 
                 if i_5 == 4:
-                    # QUERY 7: list director(s) of this film with all their other films
-                    query = """
-                    # tilde as a separator to avoid splitting at comma in film title within python
-                    # create list including all films except for current selected one by director
-                    SELECT ?directorLabel (GROUP_CONCAT(DISTINCT ?other_filmLabel; SEPARATOR = " ~ ") AS ?film_list) (COUNT(DISTINCT ?other_filmLabel) AS ?count) 
-                    WHERE {
-                      VALUES ?film {wd:%s}
-                      ?film wdt:P57 ?director. # director variable
-                      ?other_film wdt:P57 ?director; # other films need to have the same director
-                                  wdt:P31/wdt:P279* wd:Q11424;
-                                  rdfs:label ?other_filmLabel. # get labels of other films
-                      FILTER(?other_film != ?film) # sort out our current film selected by user
-                      FILTER((LANG(?other_filmLabel)) = "en") # get english labels only
-                      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-                    }
-                    GROUP BY ?directorLabel # group by director for group concat
-                    """ % entity_id
-
-                    results = get_results_request(query)
+                    # QUERY 7: director(s) of this film with all their other films
+                    results = analytics[4].result()
 
                     if len(results['results']['bindings']) == 0:
                         print(f'\nUnfortunately, "{item_label}" does not have information about its director(s). \n')
 
                     else:
-                        print(f'\n\033[1m{"Director":<20s} {"Amount":<15s} {"Films":<15s}\033[0m')
-                        for item in results["results"]["bindings"]:
-                            director = item['directorLabel']['value']
-                            count = item['count']['value']
-                            films = item['film_list']['value']
-                            # split for cleaner formatting output
-                            split_films = [film for film in films.split(' ~ ')]
-                            start = 0
-                            stop = 4
-                            combined_list = []
-                            for i in range(int(len(split_films)/4)+1):  # prevent cutting off if float gets rounded down
-                                combined_list.append(', '.join(split_films[start:stop]))
-                                start += 4
-                                stop += 4
-
-                            print(f'\n{director:<20s} {count:<15s} {combined_list[0]:<15s}')
-
-                            for films in combined_list[1:]:
-                                print(f'{"":<20s} {"":<15s} {films:<15s}')
+                        print_directors(results["results"]["bindings"])
 
                 restart_single = (1 == input_checker(input(f'\nDo you want to select another option for "{item_label}"?'
                                                            f'\n[1] Yes [2] No\n'
@@ -372,88 +2402,68 @@ def main():
             while restart_all:
 
                 i_3 = input_checker(input(f'\nEnter an integer to select an option for all {genre_str}s:\n'
-                                          f'[1] show top 10 which won most awards\n'
+                                          f'[1] show top films which won most awards\n'
                                           f'[2] show filming locations of all on a map '
                                           f'(this option will open your browser)\n'
                                           f'[3] show birthplace of swiss cast members on a map'
                                           f'\n\twith the {genre_str}s'
                                           f' they were part of (this option will open your browser)\n'
-                                          f'[4] show top 10 with biggest difference between\n\tbox office takings '
-                                          f'and cost (in USD)\n'
+                                          f'[4] show top films with biggest difference between\n\tbox office takings '
+                                          f'and cost\n'
                                           f'>> '), 1, 4)
 
                 if i_3 == 1:
-                    # QUERY 8: count awards of films, get top 10
-                    query = """
-                    SELECT ?film ?filmLabel (COUNT(?award) AS ?count) # count how many awards are returned per film
-                    WHERE {
-                      ?film wdt:P31/wdt:P279* wd:Q11424;
-                            wdt:P136 wd:%s;
-                            wdt:P166 ?award. # awards of a film
-                      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-                    }
-                    GROUP BY ?film ?filmLabel
-                    ORDER BY DESC(?count) # order by most award first
-                    LIMIT 10 # return top 10
-                    """ % film_genre_id
-
-                    results = get_results_request(query)
-
-                    print(f'\nHere are the {genre_str}s with the most awards:')
-                    print(f'\033[1m{"Awards":<10s} {"Entity ID":<15s} {"Label":<10s}\033[0m')
-                    for item in results['results']['bindings']:
-                        entity_id = item['film']['value'][31:]
-                        item_label = item['filmLabel']['value']
-                        count = item['count']['value']
-                        print(f'{count:<10s} {entity_id:<15s} {item_label:<10s} ')
+                    top, year, _, ascending = input_top_filters()
+
+                    # award counts of all films come from the genre stats, built once with QUERY 8 like queries
+                    stats = load_stats(film_genre_id, genre_str)
+                    if stats is not None:
+                        results = stats.top_awards(film_genre_id, top, year, ascending)
+
+                        print(f'\nHere are the {genre_str}s with the {"fewest" if ascending else "most"} awards:')
+                        print(f'\033[1m{"Awards":<10s} {"Entity ID":<15s} {"Label":<10s}\033[0m')
+                        table = FilmTable.from_bindings(results['results']['bindings'], ('count',))
+                        for entity_id, item_label, count in table.rows('count'):
+                            print(f'{count:<10d} {entity_id:<15s} {item_label:<10s} ')
 
                 if i_3 == 2:
-                    # query is directly included in url with specified film genre
-                    # difficult to plot everything within a map in python / cleaner view on wikidata query service
+                    # QUERY 9 show filming locations on map, drawn locally so the (cached) results are reused
+                    results = get_results_request(filming_locations_query(film_genre_id), 'genre', name='QUERY 9')
+                    features = map_features(results['results']['bindings'], 'coords', 'filmLabel', 'film')
+                    path = write_map(features, f'Filming locations of {genre_str}s', f'locations_{film_genre_id}')
 
-                    # QUERY 9 show filming locations on map:
-                    url_map = f"https://query.wikidata.org/embed.html#%23defaultView%3AMap%7B%22hide%22%3A%20%22%3Fcoords%22%7D%20%23%20this%20is%20for%20hiding%20coordinates%20in%20output%20of%20map%0ASELECT%20DISTINCT%20%3Ffilm%20%3FfilmLabel%20%3Fcoords%20%0AWHERE%20%7B%0A%3Ffilm%20wdt%3AP31%2Fwdt%3AP279*%20wd%3AQ11424%3B%20%0A%20%20%20%20%20%20%20%20%20%20%20%20%20%20wdt%3AP136%20wd%3A{film_genre_id}%3B%20%23%20films%20belonging%20to%20specific%20genre%0A%20%20%20%20%20%20%20wdt%3AP915%20%5Bwdt%3AP625%20%3Fcoords%5D.%20%23%20get%20coordinates%20of%20location%0A%20%20SERVICE%20wikibase%3Alabel%20%7B%20bd%3AserviceParam%20wikibase%3Alanguage%20%22%5BAUTO_LANGUAGE%5D%2Cen%22.%20%7D%0A%7D"
-                    webbrowser.open(url_map)
+                    print(f'\n{len(results["results"]["bindings"])} filming locations written to {path}')
+                    webbrowser.open(pathlib.Path(path).as_uri())
 
                 if i_3 == 3:
-                    # query directly included in url
                     # QUERY 10: cast members who were born in switzerland and the films they have worked on as list
-                    url_map = f"https://query.wikidata.org/embed.html#%23defaultView%3AMap%7B%22hide%22%3A%20%22%3Fcoordinates%22%7D%20%23%C2%A0hide%20coordinates%20from%20output%0ASELECT%20%3Fcast_member%20%3Fcast_memberLabel%20%3Fcoordinates%20%3Ffilm_listLabel%20WHERE%20%7B%0A%20%20%7B%0A%20%20%20%20%23%20concatenate%20all%20films%20cast%20member%20was%20part%0A%20%20%20%20SELECT%20%3Fcast_member%20%3Fcoordinates%20(GROUP_CONCAT(DISTINCT%20%3FfilmLabel%3B%20SEPARATOR%20%3D%20%22%2C%20%22)%20AS%20%3Ffilm_list)%20WHERE%20%7B%0A%20%20%0A%20%20%20%20%3Ffilm%20wdt%3AP31%2Fwdt%3AP279*%20wd%3AQ11424%3B%0A%20%20%20%20%20%20%20%20%20%20wdt%3AP136%20wd%3A{film_genre_id}%3B%0A%20%20%20%20%20%20%20%20%20%20wdt%3AP161%20%3Fcast_member%3B%20%23%20cast%20member%0A%20%20%20%20%20%20%20%20%20%20rdfs%3Alabel%20%3FfilmLabel.%20%23%20get%20film%20label%0A%20%20%20%20FILTER((LANG(%3FfilmLabel))%20%3D%20%22en%22)%20%23%20only%20get%20English%20labels%0A%20%20%20%20%3Fcast_member%20wdt%3AP27%20wd%3AQ39%3B%20%23%20cast%20member%20needs%20to%20be%20Swiss%0A%20%20%20%20%20%20%20%20%20%20%20%20%20%20%20%20%20wdt%3AP19%20%5Bwdt%3AP625%20%3Fcoordinates%5D.%20%23%20get%20coordinates%20of%20place%20of%20birth%0A%20%20%20%20%7D%0A%20%20GROUP%20BY%20%3Fcast_member%20%3Fcoordinates%20%23%20group%20needed%20for%20concatenation%0A%20%20%7D%0A%20SERVICE%20wikibase%3Alabel%20%7B%20bd%3AserviceParam%20wikibase%3Alanguage%20%22%5BAUTO_LANGUAGE%5D%2Cen%22.%20%7D%0A%7D%0A%0A%0A"
-                    webbrowser.open(url_map)
+                    results = get_results_request(swiss_cast_query(film_genre_id), 'genre', name='QUERY 10')
+                    features = map_features(results['results']['bindings'], 'coordinates', 'cast_memberLabel',
+                                            'cast_member', 'film_list')
+                    path = write_map(features, f'Birthplaces of Swiss cast members of {genre_str}s',
+                                     f'swiss_cast_{film_genre_id}')
+
+                    print(f'\n{len(results["results"]["bindings"])} birthplaces written to {path}')
+                    webbrowser.open(pathlib.Path(path).as_uri())
 
                 if i_3 == 4:
-                    # altered version of QUERY 6  films with highest difference between box office takings and cost:
-                    query = """
-                    SELECT ?film ?filmLabel (MAX(?box_office) AS ?box) ?cost ((?box - ?cost) AS ?difference) ?cost_unitLabel
-                    WHERE {
-                      ?film wdt:P31/wdt:P279* wd:Q11424; 
-                            wdt:P136 wd:%s;
-                            wdt:P2142 ?box_office;
-                            p:P2142 [psv:P2142 ?box_node]; 
-                            wdt:P2130 ?cost;
-                            p:P2130 [psv:P2130 ?cost_node].
-                      ?cost_node wikibase:quantityUnit ?cost_unit. # get currency of cost
-                      ?box_node wikibase:quantityUnit ?box_unit. # get currency of box office takings
-                      VALUES ?usd{wd:Q4917} # define variable for USD
-                      FILTER (?cost_unit = ?usd && ?box_unit = ?usd)  # only select the ones with USD for both
-                      SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-                    }
-                    GROUP BY ?film ?filmLabel ?box ?cost ?difference ?cost_unitLabel 
-                    ORDER BY DESC(?difference) # biggest difference first
-                    LIMIT 10 # return 10
-                    """ % film_genre_id
-
-                    results = get_results_request(query)
-
-                    print(f'\n\033[1m{"Difference":<15s} {"Box Office":<15s} {"Cost":<15s} {"Entity ID":<15s} {"Label":<15s}'
-                          f'\033[0m')
-                    for item in results['results']['bindings']:
-                        item_label = item['filmLabel']['value']
-                        entity_id = item['film']['value'][31:]
-                        box = int(item['box']['value'])
-                        cost = int(item['cost']['value'])
-                        diff = int(item['difference']['value'])
-                        print(f'{diff:<15,d} {box:<15,d} {cost:<15,d} {entity_id:<15s} {item_label:<15s} ')
+                    top, year, order, ascending = input_top_filters(GenreStats.box_office_labels)
+                    currency = list(currencies)[input_checker(input(
+                        f'\nSelect the currency of box office takings and cost:\n'
+                        f'{" ".join(f"[{number}] {code}" for number, code in enumerate(currencies, 1))}\n'
+                        f'>> '), 1, len(currencies)) - 1]
+
+                    # altered version of QUERY 6  films with highest difference between box office takings and cost,
+                    # or ranked by one of the other box_office_orders, answered from the genre stats
+                    stats = load_stats(film_genre_id, genre_str)
+                    if stats is not None:
+                        results = stats.top_box_office(film_genre_id, top, currency, year, order, ascending)
+
+                        print(f'\n\033[1m{"Difference":<15s} {"Box Office":<15s} {"Cost":<15s} {"Entity ID":<15s} '
+                              f'{"Label":<15s}\033[0m')
+                        table = FilmTable.from_bindings(results['results']['bindings'], ('box', 'cost', 'difference'))
+                        for entity_id, item_label, box, cost, diff in table.rows('box', 'cost', 'difference'):
+                            print(f'{diff:<15,d} {box:<15,d} {cost:<15,d} {entity_id:<15s} {item_label:<15s} ')
 
                 restart_all = (1 == input_checker(input(f'\nDo you want to select another option for {genre_str}s?'
                                                         f'\n[1] Yes [2] No\n'
@@ -464,5 +2474,87 @@ def main():
                                             f'>>  '), 1, 2))
 
 
+def cli(argv=None):
+    """
+    Non-interactive entry point, runs a report for one or more genres and exports the rows.
+    """
+    parser = argparse.ArgumentParser(description='Export Wikidata film reports for one or more genres.')
+    parser.add_argument('genres', nargs='+',
+                        help='genre as menu number (1-7), name such as "action" or Wikidata ID such as Q188473')
+    parser.add_argument('-r', '--report', choices=report_kinds, default='films',
+                        help='films: all films of the genre, awards/box_office: top n films, '
+                             'analytics: cast age, sex/gender, box office and directors of every film, '
+                             'locations/swiss_cast: filming locations and birthplaces of Swiss cast members')
+    parser.add_argument('-n', '--top', type=int, default=10, help='number of films for the top n reports')
+    parser.add_argument('--year', type=int, help='only films first published in this year (top n reports)')
+    parser.add_argument('--currency', default='USD', help='currency code or Wikidata ID for box_office '
+                                                          f'({", ".join(currencies)})')
+    parser.add_argument('--order', choices=GenreStats.box_office_orders, default='difference',
+                        help='what box_office ranks by: box office takings minus cost, takings, cost or their ratio')
+    parser.add_argument('--ascending', action='store_true', help='lowest first in the top n reports')
+    parser.add_argument('-f', '--format', choices=export_formats, default='csv')
+    parser.add_argument('-o', '--output', help='output file, standard output if omitted (not for parquet)')
+    parser.add_argument('-w', '--workers', type=int, default=max_parallel_queries,
+                        help='number of genres queried in parallel')
+    parser.add_argument('-m', '--merge', action='store_true',
+                        help='one result over all genres without duplicate films, top n across all genres')
+    parser.add_argument('--metrics', help='write query latency histograms in Prometheus text format to this file')
+    parser.add_argument('--trace', help='append one JSON line per query with its timings to this file')
+    args = parser.parse_args(argv)
+
+    try:
+        genre_ids = [resolve_genre(genre) for genre in args.genres]
+    except ValueError as error:
+        parser.error(str(error))
+    if args.top < 1:
+        parser.error('--top must be at least 1')
+    if args.format == 'parquet' and not args.output:
+        parser.error('parquet export needs --output')
+    if args.merge and args.report == 'analytics':
+        parser.error('--merge is not available for the analytics report')
+
+    metrics = add_query_hook(QueryMetrics()) if args.metrics else None
+    trace = add_query_hook(JsonLinesSink(args.trace)) if args.trace else None
+
+    if args.merge:
+        rows = (binding_row(binding) for binding in cross_genre_results(
+            genre_ids, args.report, args.top, args.year, args.currency, args.workers, args.order,
+            args.ascending)['results']['bindings'])
+    else:
+        rows = genre_reports(genre_ids, args.report, args.top, args.workers, args.year, args.currency, args.order,
+                             args.ascending)
+    try:
+        if args.format == 'parquet':
+            try:
+                count = write_rows(rows, args.output, args.format)
+            except RuntimeError as error:
+                parser.exit(1, f'{error}\n')
+        elif args.output:
+            with open(args.output, 'w', newline='', encoding='utf-8') as out:
+                count = write_rows(rows, out, args.format)
+        else:
+            count = write_rows(rows, sys.stdout, args.format)
+        print(f'{count} rows written', file=sys.stderr)
+    finally:
+        if metrics is not None:
+            query_hooks.remove(metrics)
+            metrics.write(args.metrics)
+        if trace is not None:
+            query_hooks.remove(trace)
+            trace.close()
+
+
+def start():
+    """
+    Runs the report CLI when arguments are given and the interactive menu otherwise.
+    """
+    if len(sys.argv) > 1:
+        cli()
+    else:
+        main()
+
+
+# start with "python films.py" or "python -m wikidata_films", both run the cached bytecode of this module,
+# running this file by its path compiles it on every start
 if __name__ == '__main__':
-    main()
+    start()